@@ -0,0 +1,230 @@
+import holdem_engine as hldm
+import simulation_engine as sim_engine
+import result_store
+from concurrent.futures import FIRST_COMPLETED, wait
+import argparse
+import json
+import time
+import csv
+import sys
+import os
+
+RESULT_FIELDS = ['index', 'id', 'mode', 'num_trials', 'win_rate', 'tie_rate', 'loss_rate', 'equity', 'std_error', 'equity_std_error',
+                 'elapsed', 'error']
+OPTION_TYPES = {'mode': str, 'num_rounds': int, 'seed': int, 'target_std_error': float, 'time_budget': float, 'sampling': str} # per scenario overrides
+BATCH_MODES = ('auto', 'table', 'exact', 'adaptive', 'batch', 'scalar') # Simulation.run modes per scenario ('parallel' would nest pools)
+RECORDS_PER_TASK = 32 # scenarios sent to a pool worker at a time (amortises inter process overhead)
+
+
+class BatchRunner:
+    """Class that scores a stream of scenario records (see parse_scenario) with one set of eval tables and one process pool.
+        Results are streamed back as they finish, with at most max_pending tasks in flight so memory stays bounded
+        however long the input is."""
+
+    def __init__(self, workers=None, mode='auto', num_rounds=15*1000, seed=None, target_std_error=None, time_budget=None,
+                 records_per_task=RECORDS_PER_TASK, max_pending=None, sampling='random', store=None):
+        self.workers = workers or os.cpu_count()
+        self.options = {'mode': mode, 'num_rounds': num_rounds, 'seed': seed, 'target_std_error': target_std_error,
+                        'time_budget': time_budget, 'sampling': sampling, 'store': store} # store: ResultStore directory
+        check_options(self.options)
+        self.records_per_task = records_per_task
+        self.max_pending = max_pending or 4 * self.workers
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Method that shuts down the worker pool (if one was started)"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def run(self, records):
+        """Method that takes in an iterable of scenario records (dicts) and yields one result dict per record (see RESULT_FIELDS)
+            in completion order.  Each result carries the record's position in the input ('index') and its 'id' if it had one."""
+        tasks = get_tasks(records, self.records_per_task)
+        if self.workers == 1: # no pool needed, score in this process
+            sim_engine.warm_up()
+            for task in tasks:
+                yield from run_records(task, self.options)
+            return
+
+        if self.pool is None:
+            self.pool = sim_engine.create_pool(self.workers)
+        pending = set()
+        for task in tasks:
+            pending.add(self.pool.submit(run_records, task, self.options))
+            if len(pending) >= self.max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def get_tasks(records, records_per_task):
+    """Function that groups an iterable of records into lists of (index, record) pairs, records_per_task at a time (lazily)"""
+    task = []
+    for index, record in enumerate(records):
+        task.append((index, record))
+        if len(task) == records_per_task:
+            yield task
+            task = []
+    if task:
+        yield task
+
+def check_options(options):
+    """Function that raises ValueError if run options can't be used for a batch scenario: an unknown or 'parallel' mode or no rounds"""
+    if options['mode'] == 'parallel':
+        raise ValueError("Scenarios in a batch already run in parallel; use mode 'batch' or 'auto'")
+    if options['mode'] not in BATCH_MODES:
+        raise ValueError("Unknown simulation mode: " + str(options['mode']))
+    if options['num_rounds'] < 1:
+        raise ValueError("num_rounds must be at least 1")
+
+def run_records(task, options):
+    """Function that scores a list of (index, record) pairs (in a pool worker or in process) and returns their result dicts.
+        Record fields named in OPTION_TYPES override the batch options for that scenario.  A record that can't be scored
+        (including one read_scenarios couldn't decode) gets a result with an 'error' instead of stopping the batch."""
+    results = []
+    for index, record in task:
+        result = {'index': index, 'id': record.get('id') if isinstance(record, dict) else None}
+        start_time = time.perf_counter()
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("Expected a JSON object, got " + type(record).__name__)
+            if record.get('error'): # (see read_scenarios)
+                raise ValueError(record['error'])
+            run_options = dict(options)
+            for name, option_type in OPTION_TYPES.items():
+                if record.get(name) not in (None, ''):
+                    run_options[name] = option_type(record[name])
+            check_options(run_options)
+            if run_options.get('store'):
+                run_options['store'] = result_store.get_store(run_options['store'])
+            sim_results = sim_engine.Simulation(parse_scenario(record)).run(**run_options)
+            if sim_results is None:
+                raise ValueError("No rounds were simulated")
+            result.update({field: getattr(sim_results, field) for field in RESULT_FIELDS[2:-2]})
+        except Exception as error: # one bad record mustn't take down the other records of its task
+            result['error'] = str(error) or type(error).__name__
+        result['elapsed'] = time.perf_counter() - start_time
+        results.append(result)
+    return results
+
+def parse_scenario(record):
+    """Function that builds a Scenario from a record (dict) with the fields
+        'hole_cards': the user's known hole cards, e.g. 'AsKd' (string or list of card names; optional)
+        'board': the known board cards, e.g. 'Qh 7h 2c' (optional)
+        'opponents': the number of opponents (defaults to the number of ranges)
+        'ranges': opponent hand ranges (list, or one string separated by ';'); opponents without one get random cards
+        'range': a hand range for the user when 'hole_cards' is empty"""
+    def get_cards(field):
+        value = record.get(field) or ''
+        return hldm.str_to_cards(value if isinstance(value, str) else ''.join(value))
+
+    user = hldm.Player()
+    user.hole_cards = get_cards('hole_cards')
+    if record.get('range'):
+        user.assign_range(sim_engine.Range(record['range']))
+    board_cards = get_cards('board')
+
+    ranges = record.get('ranges') or []
+    if isinstance(ranges, str):
+        ranges = [notation for notation in ranges.split(';') if notation.strip()]
+    num_opponents = int(record.get('opponents') or len(ranges))
+    if num_opponents < 1 or num_opponents < len(ranges):
+        raise ValueError("Invalid number of opponents: " + str(num_opponents))
+    opponents = []
+    for i in range(num_opponents):
+        opponent = hldm.Player()
+        if i < len(ranges):
+            opponent.assign_range(sim_engine.Range(ranges[i]))
+        opponents.append(opponent)
+
+    card_ids = [card.id for card in user.hole_cards + board_cards]
+    if len(user.hole_cards) > 2 or len(board_cards) > 5 or len(set(card_ids)) != len(card_ids):
+        raise ValueError("Invalid cards: " + str(record.get('hole_cards')) + " / " + str(record.get('board')))
+
+    return sim_engine.Scenario(user, opponents, board_cards)
+
+def read_scenarios(file, file_format='jsonl'):
+    """Function that lazily reads scenario records from an open file: one JSON object per line ('jsonl') or CSV rows with a header ('csv').
+        A line that isn't valid JSON is read as a record holding only an 'error' (see run_records), so the batch goes on."""
+    if file_format == 'csv':
+        yield from csv.DictReader(file)
+        return
+    for line_number, line in enumerate(file, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                yield {'error': "Invalid JSON on line " + str(line_number) + ": " + str(error)}
+
+def write_results(results, file, file_format='jsonl'):
+    """Function that writes result dicts to an open file as they arrive (JSON lines or CSV with a header), flushing after each one,
+        and returns the number of results written"""
+    num_results = 0
+    writer = None
+    if file_format == 'csv':
+        writer = csv.DictWriter(file, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+    for result in results:
+        if writer is None:
+            file.write(json.dumps(result) + '\n')
+        else:
+            writer.writerow(result)
+        file.flush()
+        num_results += 1
+    return num_results
+
+def get_format(path, file_format):
+    """Function that returns the given file format, or guesses it from the file extension (CSV or JSON lines)"""
+    if file_format is not None:
+        return file_format
+    return 'csv' if path is not None and path.lower().endswith('.csv') else 'jsonl'
+
+def main(argv=None):
+    """Command line entry point: scores every scenario of an input file (or stdin) and streams the results to an output file (or stdout)"""
+    parser = argparse.ArgumentParser(description="Score a stream of Texas Hold'em scenarios (JSON lines or CSV) in one batch")
+    parser.add_argument('input', nargs='?', help="scenario file (JSON lines or CSV); stdin if omitted")
+    parser.add_argument('-o', '--output', help="result file (JSON lines or CSV); stdout if omitted")
+    parser.add_argument('--input-format', choices=['jsonl', 'csv'], help="defaults to the input file extension")
+    parser.add_argument('--output-format', choices=['jsonl', 'csv'], help="defaults to the output file extension")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per core)")
+    parser.add_argument('--mode', default='auto', help="simulation mode (see Simulation.run)")
+    parser.add_argument('--rounds', type=int, default=15*1000, help="rounds per scenario for the simulated modes")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--target-std-error', type=float)
+    parser.add_argument('--time-budget', type=float, help="seconds per scenario")
+    parser.add_argument('--sampling', default='random', choices=sim_engine.SAMPLING_SCHEMES, help="how deals are drawn (see Simulation.run)")
+    parser.add_argument('--store', help="result store directory: reuse stored results and save new ones (see result_store.py)")
+    args = parser.parse_args(argv)
+
+    input_file = open(args.input, newline='') if args.input else sys.stdin
+    output_file = open(args.output, 'w', newline='') if args.output else sys.stdout
+    start_time = time.perf_counter()
+    try:
+        records = read_scenarios(input_file, get_format(args.input, args.input_format))
+        with BatchRunner(args.workers, args.mode, args.rounds, args.seed, args.target_std_error, args.time_budget,
+                         sampling=args.sampling, store=args.store) as runner:
+            num_results = write_results(runner.run(records), output_file, get_format(args.output, args.output_format))
+    finally:
+        if args.input:
+            input_file.close()
+        if args.output:
+            output_file.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(str(num_results) + " scenarios in " + str(round(elapsed, 2)) + " s (" + str(round(num_results / max(elapsed, 1e-9))) + " per second)",
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
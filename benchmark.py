@@ -0,0 +1,214 @@
+import holdem_engine as hldm
+import simulation_engine as sim_engine
+import hash_tools
+import numpy as np
+import tracemalloc
+import argparse
+import platform
+import random
+import json
+import time
+import sys
+import os
+
+BENCHMARK_VERSION = 1 # bump when metrics change meaning, so old baselines aren't compared against them
+BASELINE_PATH = 'benchmark_baseline.json'
+REGRESSION_TOLERANCE = 0.5 # a metric more than 50% worse than its baseline is a regression (timings on a busy machine vary by ~30%)
+
+# fixed scenarios: the user's hole cards and the board at each street
+USER_CARDS = 'AhKh'
+STREET_BOARDS = {'preflop': '', 'flop': 'Qh 7h 2c', 'turn': 'Qh 7h 2c 9s', 'river': 'Qh 7h 2c 9s 3d'}
+MAX_OPPONENTS = 8
+
+
+class Benchmark:
+    """Class that times the evaluator and simulation engine on fixed, seeded inputs and collects the results as metrics
+        (name -> value, unit and whether higher or lower is better)"""
+
+    def __init__(self, num_hands=50*1000, num_rounds=100*1000, repeat=5, seed=0):
+        self.num_hands = num_hands # hands timed per evaluation metric
+        self.num_rounds = num_rounds # rounds per Simulation.run
+        self.repeat = repeat # every timing is the best of this many runs
+        self.seed = seed
+        self.metrics = {}
+
+    def add_metric(self, name, value, unit, higher_is_better=False):
+        """Method that records a metric"""
+        self.metrics[name] = {'value': value, 'unit': unit, 'better': 'higher' if higher_is_better else 'lower'}
+
+    def time_best(self, function):
+        """Method that calls function repeat times and returns the fastest time in seconds"""
+        best = None
+        for _ in range(self.repeat):
+            start_time = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start_time
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def run(self, progress=None):
+        """Method that runs every benchmark and returns the metrics.  progress(name) is called before each group."""
+        for name, benchmark in [('table load', self.bench_table_load), ('hand evaluation', self.bench_evaluation),
+                                ('simulation', self.bench_simulation), ('memory', self.bench_memory)]:
+            if progress is not None:
+                progress(name)
+            benchmark()
+        return self.metrics
+
+    def bench_table_load(self):
+        """Method that times loading the eval tables (a new Evaluator, as each process does on first use)"""
+        elapsed = self.time_best(hash_tools.Evaluator)
+        self.add_metric('table_load', elapsed * 1000, 'ms')
+
+    def bench_evaluation(self):
+        """Method that times Hand.evaluate (against the sequential reference and the card mask path), Simulation.get_score and
+            Evaluator.evaluate_batch on the same seeded 7 card hands"""
+        rndm = random.Random(self.seed)
+        hands = [rndm.sample(range(1, 53), 7) for _ in range(self.num_hands)]
+        card_hands = [[hldm.int_to_card(card_id) for card_id in card_ids] for card_ids in hands]
+        masks = [hldm.cards_to_mask(cards) for cards in card_hands]
+
+        def evaluate_hands():
+            for cards in card_hands:
+                hldm.Hand().evaluate(cards)
+        elapsed = self.time_best(evaluate_hands)
+        self.add_metric('hand_evaluate', elapsed / len(hands) * 1e6, 'us/hand')
+
+        def evaluate_masks():
+            for mask in masks:
+                hldm.Hand().evaluate_mask(mask)
+        self.add_metric('hand_evaluate_mask', self.time_best(evaluate_masks) / len(hands) * 1e6, 'us/hand')
+
+        def evaluate_sequential():
+            for cards in card_hands:
+                hldm.Hand().evaluate_sequential(cards)
+        sequential_elapsed = self.time_best(evaluate_sequential)
+        self.add_metric('hand_evaluate_sequential', sequential_elapsed / len(hands) * 1e6, 'us/hand')
+        self.add_metric('hand_evaluate_speedup', sequential_elapsed / elapsed, 'x', True) # single pass vs. the original checks
+
+        simulation = sim_engine.Simulation(sim_engine.Scenario(hldm.Player(), [], []))
+        def score_hands():
+            for card_ids in hands:
+                simulation.get_score(card_ids[:5], card_ids[5:])
+        elapsed = self.time_best(score_hands)
+        self.add_metric('get_score', elapsed / len(hands) * 1e6, 'us/hand')
+
+        hand_array = np.array(hands, dtype=np.int64)
+        elapsed = self.time_best(lambda: simulation.evaluator.evaluate_batch(hand_array))
+        self.add_metric('evaluate_batch', elapsed / len(hands) * 1e9, 'ns/hand')
+
+    def get_simulation(self, street, num_opponents):
+        """Method that returns a Simulation of the fixed scenario at a street against num_opponents random opponents"""
+        user = hldm.Player()
+        user.hole_cards = hldm.str_to_cards(USER_CARDS)
+        board_cards = hldm.str_to_cards(STREET_BOARDS[street]) if STREET_BOARDS[street] else []
+        return sim_engine.Simulation(sim_engine.Scenario(user, [hldm.Player() for _ in range(num_opponents)], board_cards))
+
+    def bench_simulation(self):
+        """Method that measures Simulation.run trials per second (mode 'batch', no result cache) at every street against
+            1 to MAX_OPPONENTS opponents.  runout_cache is cleared before every run so each is timed from a cold start."""
+        for street in STREET_BOARDS:
+            for num_opponents in range(1, MAX_OPPONENTS + 1):
+                simulation = self.get_simulation(street, num_opponents)
+                def run_simulation():
+                    sim_engine.runout_cache.clear()
+                    simulation.run(mode='batch', seed=self.seed, num_rounds=self.num_rounds, use_cache=False)
+                elapsed = self.time_best(run_simulation)
+                self.add_metric('trials_per_second/' + street + '/' + str(num_opponents), self.num_rounds / elapsed, 'trials/s', True)
+
+    def bench_memory(self):
+        """Method that records the peak memory traced (Python and NumPy allocations) during the largest simulation and the
+            process's peak resident memory, where the platform reports it"""
+        simulation = self.get_simulation('flop', MAX_OPPONENTS)
+        sim_engine.runout_cache.clear()
+        tracemalloc.start()
+        try:
+            simulation.run(mode='batch', seed=self.seed, num_rounds=self.num_rounds, use_cache=False)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.add_metric('simulation_peak_memory', peak / 2**20, 'MB')
+
+        try:
+            import resource
+        except ImportError: # not available on Windows
+            return
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin': # bytes on macOS, kilobytes elsewhere
+            max_rss /= 1024
+        self.add_metric('peak_rss', max_rss / 1024, 'MB')
+
+def get_report(metrics, benchmark):
+    """Function that returns the JSON serialisable report of a benchmark run (settings, machine and metrics)"""
+    return {'version': BENCHMARK_VERSION,
+            'settings': {'num_hands': benchmark.num_hands, 'num_rounds': benchmark.num_rounds, 'repeat': benchmark.repeat, 'seed': benchmark.seed},
+            'machine': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()},
+            'metrics': metrics}
+
+def compare_reports(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Function that compares a report's metrics with a baseline report's and returns a list of (name, value, baseline value, change)
+        for every regression: a metric more than tolerance (fraction) worse than its baseline.  Metrics missing from either are skipped."""
+    if baseline.get('version') != report['version']:
+        raise ValueError("The baseline was written by benchmark version " + str(baseline.get('version')) + ", not " + str(report['version']))
+
+    regressions = []
+    for name, metric in report['metrics'].items():
+        baseline_metric = baseline['metrics'].get(name)
+        if baseline_metric is None or not baseline_metric['value']:
+            continue
+        change = metric['value'] / baseline_metric['value'] - 1
+        worse = -change if metric['better'] == 'higher' else change
+        if worse > tolerance:
+            regressions.append((name, metric['value'], baseline_metric['value'], change))
+    return regressions
+
+def main(argv=None):
+    """Command line entry point: runs the benchmarks, writes the JSON report and exits with status 1 on any regression from the baseline
+        (status 2 if there is no baseline to compare against, unless --save-baseline writes one)"""
+    parser = argparse.ArgumentParser(description="Benchmark the hand evaluator and simulation engine against a stored baseline")
+    parser.add_argument('-o', '--output', help="report file (JSON); stdout if omitted")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline report to compare against (exit status 2 if it doesn't exist)")
+    parser.add_argument('--save-baseline', action='store_true', help="write this run's report as the new baseline instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE, help="allowed fraction a metric can be worse than its baseline")
+    parser.add_argument('--hands', type=int, default=50*1000, help="hands timed per evaluation metric")
+    parser.add_argument('--rounds', type=int, default=100*1000, help="rounds per simulation")
+    parser.add_argument('--repeat', type=int, default=5, help="every timing is the best of this many runs")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.hands, args.rounds, args.repeat, args.seed)
+    metrics = benchmark.run(lambda name: print("Benchmarking " + name + "...", file=sys.stderr))
+    report = get_report(metrics, benchmark)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            baseline_file.write(text + '\n')
+        print("Baseline saved to " + args.baseline, file=sys.stderr)
+        return 0
+    if not os.path.exists(args.baseline): # a check without a baseline would pass every regression
+        print("No baseline at " + args.baseline + " (run with --save-baseline on the reference machine to create one)", file=sys.stderr)
+        return 2
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare_reports(report, baseline, args.tolerance)
+    for name, value, baseline_value, change in regressions:
+        print("REGRESSION " + name + ": " + str(round(value, 3)) + " vs. baseline " + str(round(baseline_value, 3)) +
+              " (" + str(round(change * 100, 1)) + "%)", file=sys.stderr)
+    if regressions:
+        print(str(len(regressions)) + " of " + str(len(report['metrics'])) + " metrics regressed", file=sys.stderr)
+        return 1
+    print("No regressions against " + args.baseline, file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+import simulation_engine as sim_engine
+import batch_engine
+from collections import deque
+import http.client
+import argparse
+import asyncio
+import json
+import time
+import sys
+import os
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_TIME_BUDGET = 0.5 # seconds a request may simulate for when it doesn't ask for a time_budget
+DEFAULT_TARGET_STD_ERROR = 0.0025 # adaptive requests stop here (a ~1% wide 95% confidence interval) unless they ask otherwise
+MAX_TIME_BUDGET = 10.0
+TIMEOUT_GRACE = 1.0 # extra seconds a request waits (queueing, exact enumeration) before it times out with 504
+MAX_ROUNDS = 1000*1000 # cap on num_rounds (the precision a stored result must have, see simulation_engine.get_required_std_error)
+SERVICE_MODES = ('auto', 'table', 'exact', 'adaptive') # modes bounded by the time budget (or, for 'exact', by EXACT_MAX_OUTCOMES)
+MAX_BODY_SIZE = 64*1024
+LATENCY_WINDOW = 1000 # recent request latencies kept for the percentiles in /stats
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+               500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class EquityService:
+    """Class that answers equity requests over HTTP (asyncio, stdlib only) from a warm process pool.
+        POST /equity takes a scenario record as JSON (see batch_engine.parse_scenario, plus the batch_engine.OPTION_TYPES
+        overrides) and returns its result (see batch_engine.RESULT_FIELDS); GET /health and GET /stats report on the service.
+        Identical scenarios in flight at the same time (same canonical scenario and options) share one simulation, every request
+        is given a time budget, and once max_pending simulations are in flight new ones are turned away with 503 (backpressure)."""
+
+    def __init__(self, workers=None, max_pending=None, default_time_budget=DEFAULT_TIME_BUDGET, max_time_budget=MAX_TIME_BUDGET, store=None):
+        self.workers = workers or os.cpu_count()
+        self.pool = sim_engine.create_pool(self.workers)
+        self.max_pending = max_pending or 4 * self.workers
+        self.default_time_budget = default_time_budget
+        self.max_time_budget = max_time_budget
+        self.store = store # ResultStore directory shared by the workers (see result_store.py), or None
+        self.in_flight = {} # (canonical scenario, options) -> asyncio Future of the simulation
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {'requests': 0, 'simulations': 0, 'coalesced': 0, 'rejected': 0, 'timeouts': 0, 'errors': 0}
+
+        # start every worker now (they load the eval tables as they start) so the first requests don't pay for it
+        for future in [self.pool.submit(warm_worker) for _ in range(self.workers)]:
+            future.result()
+
+    def close(self):
+        """Method that shuts down the worker pool"""
+        self.pool.shutdown(cancel_futures=True)
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Method that starts listening and returns the asyncio Server"""
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Method that serves requests until cancelled"""
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """Method that reads HTTP/1.1 requests from a connection (keep alive) and writes their responses"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin-1').split()
+                length = int(headers.get('content-length') or 0)
+                if len(parts) != 3:
+                    status, payload = 400, {'error': "Malformed request line"}
+                elif length > MAX_BODY_SIZE:
+                    status, payload = 413, {'error': "Request body over " + str(MAX_BODY_SIZE) + " bytes"}
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, payload = await self.dispatch(parts[0], parts[1], body)
+                    except Exception as error: # (e.g. a broken worker pool) answer rather than drop the connection
+                        self.stats['errors'] += 1
+                        status, payload = 500, {'error': "Internal error: " + (str(error) or type(error).__name__)}
+
+                keep_alive = len(parts) == 3 and parts[2] == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                keep_alive = keep_alive and status != 413 # the unread body would be taken for the next request
+                writer.write(get_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        """Method that routes a request and returns its (status, JSON payload)"""
+        path = path.split('?')[0]
+        if path == '/equity':
+            if method != 'POST':
+                return 405, {'error': "Use POST"}
+            try:
+                record = json.loads(body or b'{}')
+                if not isinstance(record, dict):
+                    raise ValueError("Expected a JSON object")
+            except ValueError as error:
+                return 400, {'error': "Invalid JSON: " + str(error)}
+            return await self.get_equity(record)
+        if method != 'GET':
+            return 405, {'error': "Use GET"}
+        if path == '/health':
+            return 200, {'status': 'ok', 'workers': self.workers}
+        if path == '/stats':
+            return 200, self.get_stats()
+        return 404, {'error': "Unknown path: " + path}
+
+    def get_options(self, record):
+        """Method that returns the Simulation.run options of a request: the record's overrides (batch_engine.OPTION_TYPES) with
+            its time budget clamped to max_time_budget and num_rounds to MAX_ROUNDS (see batch_engine.check_options for the rest)"""
+        options = {'mode': 'auto', 'num_rounds': 15*1000, 'seed': None, 'target_std_error': DEFAULT_TARGET_STD_ERROR, 'time_budget': None,
+                   'sampling': 'random', 'store': self.store}
+        for name, option_type in batch_engine.OPTION_TYPES.items():
+            if record.get(name) not in (None, ''):
+                options[name] = option_type(record[name])
+        if options['mode'] not in SERVICE_MODES: # 'batch', 'scalar' and 'parallel' ignore the time budget and would pin workers
+            raise ValueError("Mode '" + options['mode'] + "' isn't served (it ignores the time budget); use one of " + ', '.join(SERVICE_MODES))
+        batch_engine.check_options(options)
+
+        options['time_budget'] = min(options['time_budget'] or self.default_time_budget, self.max_time_budget)
+        if options['time_budget'] <= 0:
+            raise ValueError("time_budget must be positive")
+        options['num_rounds'] = min(options['num_rounds'], MAX_ROUNDS)
+        return options
+
+    async def get_equity(self, record):
+        """Method that answers one equity request, joining an identical simulation already in flight if there is one"""
+        start_time = time.perf_counter()
+        self.stats['requests'] += 1
+        try:
+            options = self.get_options(record)
+            scenario = batch_engine.parse_scenario(record)
+            # exact enumeration holds every deal in memory, so a worker only enumerates what mode 'auto' would
+            if options['mode'] == 'exact' and sim_engine.Simulation(scenario).count_outcomes() > sim_engine.EXACT_MAX_OUTCOMES:
+                raise ValueError("Too many deals to enumerate exactly (at most " + str(sim_engine.EXACT_MAX_OUTCOMES) + "); use mode 'auto'")
+            key = (sim_engine.get_canonical_scenario(scenario), tuple(sorted(options.items())))
+        except (ValueError, KeyError, TypeError) as error:
+            self.stats['errors'] += 1
+            return 400, {'error': str(error)}
+
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+        else:
+            if len(self.in_flight) >= self.max_pending:
+                self.stats['rejected'] += 1
+                return 503, {'error': "Too many requests in flight, retry shortly"}
+            # the options are passed resolved, so the record's own (unclamped) overrides are left out
+            scenario_record = {name: value for name, value in record.items() if name not in batch_engine.OPTION_TYPES}
+            future = asyncio.get_running_loop().run_in_executor(self.pool, run_request, scenario_record, options)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self.in_flight.pop(key, None) if self.in_flight.get(key) is done else None)
+            self.stats['simulations'] += 1
+
+        try:
+            # shielded so a timed out request doesn't cancel the simulation for the requests sharing it
+            result = await asyncio.wait_for(asyncio.shield(future), options['time_budget'] + TIMEOUT_GRACE)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            return 504, {'error': "No result within the time budget"}
+        except Exception as error: # e.g. a broken worker pool; the client still gets a response
+            self.stats['errors'] += 1
+            return 500, {'error': "Simulation failed: " + (str(error) or type(error).__name__)}
+        self.latencies.append(time.perf_counter() - start_time)
+
+        result = dict(result, id=record.get('id'))
+        if result.get('error'):
+            self.stats['errors'] += 1
+            return 400, result
+        return 200, result
+
+    def get_stats(self):
+        """Method that returns the service counters, the simulations in flight and recent latency percentiles (seconds)"""
+        stats = dict(self.stats, in_flight=len(self.in_flight), max_pending=self.max_pending)
+        latencies = sorted(self.latencies)
+        for percentile in (50, 95, 99):
+            stats['latency_p' + str(percentile)] = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)] if latencies else None
+        return stats
+
+def warm_worker():
+    """Function that loads the eval tables in a pool worker (returns nothing, so the tables aren't sent back)"""
+    sim_engine.warm_up()
+
+def run_request(record, options):
+    """Function that scores one scenario record in a pool worker and returns its result dict (see batch_engine.run_records)"""
+    result = batch_engine.run_records([(0, record)], options)[0]
+    del result['index']
+    return result
+
+def get_response(status, payload, keep_alive=True):
+    """Function that returns the bytes of an HTTP/1.1 response with a JSON body"""
+    body = json.dumps(payload).encode()
+    headers = ['HTTP/1.1 ' + str(status) + ' ' + STATUS_TEXT.get(status, ''), 'Content-Type: application/json',
+               'Content-Length: ' + str(len(body)), 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+    if status == 503:
+        headers.append('Retry-After: 1')
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+def request_equity(record, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=30, connection=None):
+    """Function that posts a scenario record to a running EquityService (stdlib client) and returns (status, result dict).
+        Pass an http.client.HTTPConnection as connection to reuse it across requests."""
+    client = connection or http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        client.request('POST', '/equity', json.dumps(record), {'Content-Type': 'application/json'})
+        response = client.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        if connection is None:
+            client.close()
+
+def main(argv=None):
+    """Command line entry point: 'serve' runs the service, 'query' sends one scenario (JSON) to a running service"""
+    parser = argparse.ArgumentParser(description="Local equity service (HTTP, JSON) backed by a warm simulation pool")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help="run the service")
+    serve_parser.add_argument('--workers', type=int, help="worker processes (default: one per core)")
+    serve_parser.add_argument('--max-pending', type=int, help="simulations in flight before requests are turned away (default: 4 per worker)")
+    serve_parser.add_argument('--time-budget', type=float, default=DEFAULT_TIME_BUDGET, help="default seconds per request")
+    serve_parser.add_argument('--store', help="result store directory: reuse stored results and save new ones (see result_store.py)")
+    query_parser = commands.add_parser('query', help="send one scenario to a running service")
+    query_parser.add_argument('record', help="""scenario as JSON, e.g. '{"hole_cards": "AsKd", "board": "Qh 7h 2c", "opponents": 2}'""")
+    args = parser.parse_args(argv)
+
+    if args.command == 'query':
+        status, result = request_equity(json.loads(args.record), args.host, args.port)
+        print(json.dumps(result))
+        return 0 if status == 200 else 1
+
+    service = EquityService(args.workers, args.max_pending, args.time_budget, store=args.store)
+    print("Serving on http://" + args.host + ":" + str(args.port) + " with " + str(service.workers) + " workers", file=sys.stderr)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
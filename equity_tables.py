@@ -0,0 +1,269 @@
+import holdem_engine as hldm
+import simulation_engine as sim_engine
+import hash_tools
+from concurrent.futures import as_completed
+import numpy as np
+import itertools
+import threading
+import math
+import os
+
+PREFLOP_TABLE_PATH = os.path.join(hash_tools.TABLE_DIR, 'preflop_equity.npy')
+FLOP_TABLE_PATH = os.path.join(hash_tools.TABLE_DIR, 'flop_equity.npy')
+FLOP_CHECKPOINT_DIR = os.path.join(hash_tools.TABLE_DIR, 'flop_equity_parts') # one finished part per canonical flop (see build_flop_table)
+MAX_OPPONENTS = 8 # opponent counts covered by the precomputed tables (matches main.createNumOppsDropDown)
+
+_preflop_table = None # lazily loaded PreflopTable (False if there is no table file)
+_preflop_table_lock = threading.Lock()
+_flop_table = None # lazily loaded FlopTable (False if there is no table file)
+_flop_table_lock = threading.Lock()
+
+# heads-up flop deals of one (hole cards, flop) pair: every turn and river, then every opponent holding
+FLOP_DEALS = math.comb(52 - 5, 2) * math.comb(52 - 7, 2)
+# a record of the flop table: the (hole cards, flop) key (see get_flop_key), the user's wins and ties over its FLOP_DEALS deals and
+# the number of turn and river completions giving the user each hand type (every completion is dealt against each opponent holding)
+FLOP_RECORD = np.dtype([('key', '<u4'), ('wins', '<u4'), ('ties', '<u4'), ('hand_types', '<u2', (len(hash_tools.HAND_TYPES),))])
+
+
+def get_hand_class_name(hand_class):
+    """Function that returns the standard name of a starting hand class index (e.g. 'AA', 'AKs', 'T9o')"""
+    row, column = divmod(hand_class, 13)
+    if row == column:
+        return hldm.VALUE_CHARS[row] * 2
+    if row > column:
+        return hldm.VALUE_CHARS[row] + hldm.VALUE_CHARS[column] + 's'
+    return hldm.VALUE_CHARS[column] + hldm.VALUE_CHARS[row] + 'o'
+
+def get_hand_class_ids(hand_class):
+    """Function that returns 2 Card ids representing a starting hand class (suited hands use one suit, the others two suits)"""
+    row, column = divmod(hand_class, 13)
+    if row > column:
+        return [row * 4 + 1, column * 4 + 1]
+    return [max(row, column) * 4 + 1, min(row, column) * 4 + 2]
+
+def build_preflop_table(num_rounds=1000*1000, seed=0, workers=None, path=PREFLOP_TABLE_PATH):
+    """Function that simulates every starting hand class against 1 to MAX_OPPONENTS opponents (num_rounds deals each, run in
+        parallel) and writes their totals arrays (rounds, wins, ties, pot shares and user hand types; see simulation_engine.TOTALS_SIZE)
+        to a (169, MAX_OPPONENTS, TOTALS_SIZE) integer table"""
+    deck = hldm.Deck()
+    cards = {card.id: card for card in deck.cards}
+
+    table = np.zeros((169, MAX_OPPONENTS, sim_engine.TOTALS_SIZE), dtype=np.int64)
+    pool = sim_engine.create_pool(workers)
+    try:
+        for hand_class in range(169):
+            user = hldm.Player()
+            user.hole_cards = [cards[card_id] for card_id in get_hand_class_ids(hand_class)]
+            for num_opponents in range(1, MAX_OPPONENTS + 1):
+                scenario = sim_engine.Scenario(user, [hldm.Player() for _ in range(num_opponents)], [])
+                simulation = sim_engine.Simulation(scenario)
+                table[hand_class, num_opponents - 1] = simulation.run_parallel(num_rounds, [seed, hand_class, num_opponents], pool)[0]
+            print(get_hand_class_name(hand_class) + " done (" + str(hand_class + 1) + " of 169)")
+    finally:
+        pool.shutdown()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.save(path, table)
+
+class PreflopTable:
+    """Class that answers preflop scenarios (2 known hole cards, no board, uniform random opponents without known cards or ranges) from the precomputed table"""
+
+    def __init__(self, path=PREFLOP_TABLE_PATH):
+        self.table = np.load(path)
+
+    def lookup(self, scenario):
+        """Method that returns the precomputed totals array for a Scenario, or None if the table doesn't cover it"""
+        num_opponents = len(scenario.opponents)
+        if len(scenario.board_cards) != 0 or len(scenario.user.hole_cards) != 2 or not 1 <= num_opponents <= MAX_OPPONENTS:
+            return None
+        if any(opponent.hole_cards or sim_engine.get_dealt_range(opponent) is not None for opponent in scenario.opponents):
+            return None # the table assumes random opponents
+        totals = self.table[hldm.get_hand_class([card.id for card in scenario.user.hole_cards]), num_opponents - 1]
+        if totals[0] == 0:
+            return None
+        return totals.copy()
+
+def get_preflop_table():
+    """Function that returns the process wide PreflopTable (loaded on first use), or None if the table hasn't been built
+        (or was built for another TOTALS_SIZE)"""
+    global _preflop_table
+    if _preflop_table is None:
+        with _preflop_table_lock:
+            if _preflop_table is None:
+                _preflop_table = PreflopTable(PREFLOP_TABLE_PATH) if os.path.exists(PREFLOP_TABLE_PATH) else False
+                if _preflop_table and _preflop_table.table.shape[2] != sim_engine.TOTALS_SIZE:
+                    _preflop_table = False # built for another totals layout (see simulation_engine.TOTALS_SIZE); needs a rebuild
+    return _preflop_table or None
+
+def get_flop_key(hole_ids, flop_ids):
+    """Function that takes in (n, 2) hole Card ids and (n, 3) flop Card ids (arrays) and returns the n canonical keys of the
+        (hole cards, flop) pairs: the 5 sorted Card ids (hole cards first, 6 bits each) packed into an integer, minimised over all
+        24 suit permutations so suit isomorphic pairs share one key"""
+    hole_ids = np.asarray(hole_ids, dtype=np.int64) - 1
+    flop_ids = np.asarray(flop_ids, dtype=np.int64) - 1
+    key = None
+    for suits in np.array(sim_engine.SUIT_PERMUTATIONS):
+        # relabel the suits, then pack the sorted hole and flop ids (most significant first, so keys compare like the id tuples)
+        ids = np.hstack([np.sort(hole_ids - hole_ids % 4 + suits[hole_ids % 4], axis=1), np.sort(flop_ids - flop_ids % 4 + suits[flop_ids % 4], axis=1)]) + 1
+        form = (((ids[:, 0] * 64 + ids[:, 1]) * 64 + ids[:, 2]) * 64 + ids[:, 3]) * 64 + ids[:, 4]
+        key = form if key is None else np.minimum(key, form)
+    return key
+
+def get_canonical_flops():
+    """Function that returns one flop (a tuple of 3 Card ids) per suit isomorphism class (1755 flops).
+        Every canonical (hole cards, flop) pair has a representative on one of them."""
+    flops = np.array(list(itertools.combinations(range(1, 53), 3)), dtype=np.int64) - 1
+    canonical = np.ones(len(flops), dtype=bool)
+    for suits in np.array(sim_engine.SUIT_PERMUTATIONS):
+        # a flop is canonical if no suit relabelling gives a smaller sorted id tuple
+        relabelled = np.sort(flops - flops % 4 + suits[flops % 4], axis=1)
+        smaller = (relabelled[:, 0] * 64 + relabelled[:, 1]) * 64 + relabelled[:, 2] < (flops[:, 0] * 64 + flops[:, 1]) * 64 + flops[:, 2]
+        canonical &= ~smaller
+    canonical = flops[canonical] + 1
+    return [tuple(int(card_id) for card_id in flop) for flop in canonical]
+
+def compute_flop_equity(flop_ids, evaluator=None, chunk_size=16):
+    """Function that computes the exact heads-up equity of every hole card pair on a flop against a random opponent and returns it
+        as FLOP_RECORD records, one per canonical (hole cards, flop) key, sorted by key.
+        Every holding's rank on every turn and river is looked up in the flop's runout table (simulation_engine.build_runout_table);
+        per completion, the opponent holdings a user holding beats or ties are counted from a histogram of all live holdings' ranks,
+        less the holdings sharing a card with the user's."""
+    if evaluator is None:
+        evaluator = sim_engine.get_evaluator()
+    holding_ids = sim_engine.HOLDING_IDS
+    holding_masks = (1 << holding_ids).sum(axis=1)
+    live = np.flatnonzero((holding_masks & sum(1 << card_id for card_id in flop_ids)) == 0) # holdings (and completions) off the flop
+    runout = sim_engine.build_runout_table(evaluator, list(flop_ids))
+    ranks = runout[live][:, live].astype(np.int16) # [turn and river, user holding], both over the live holdings
+    live_masks = holding_masks[live]
+    num_ranks = len(sim_engine.RANK_HAND_TYPES)
+
+    # each live holding's conflicts: the live holdings sharing a card with it (itself included)
+    positions = np.full(len(holding_ids), -1, dtype=np.int64)
+    positions[live] = np.arange(len(live))
+    conflicts = []
+    for card_1, card_2 in holding_ids[live]:
+        others = [card_id for card_id in range(1, 53) if card_id not in flop_ids]
+        conflicts.append([positions[sim_engine.HOLDING_INDEX[card_1, card_id]] for card_id in others if card_id != card_1] +
+                         [positions[sim_engine.HOLDING_INDEX[card_2, card_id]] for card_id in others if card_id not in (card_1, card_2)])
+    conflicts = np.array(conflicts, dtype=np.int64)
+
+    wins = np.zeros(len(live), dtype=np.int64)
+    ties = np.zeros(len(live), dtype=np.int64)
+    hand_types = np.zeros(len(live) * sim_engine.NUM_HAND_TYPES, dtype=np.int64)
+    for start in range(0, len(live), chunk_size):
+        chunk_ranks = ranks[start:start + chunk_size]
+        valid = (live_masks[start:start + chunk_size, np.newaxis] & live_masks) == 0 # holdings off the turn and river
+        num_rows = len(chunk_ranks)
+
+        # per completion: how many valid holdings rank at or below (lower is better) each rank, and how many at each rank
+        offsets = np.arange(num_rows)[:, np.newaxis] * num_ranks
+        counts = np.bincount((chunk_ranks + offsets)[valid], minlength=num_rows * num_ranks).reshape(num_rows, num_ranks)
+        rows = np.arange(num_rows)[:, np.newaxis]
+        worse = valid.sum(axis=1, keepdims=True) - counts.cumsum(axis=1)[rows, chunk_ranks]
+        equal = counts[rows, chunk_ranks]
+
+        # less the valid holdings sharing a card with the user's (the user's own holding ties itself)
+        conflict_ranks = chunk_ranks[:, conflicts]
+        conflict_valid = valid[:, conflicts]
+        user_ranks = chunk_ranks[:, :, np.newaxis]
+        worse = worse - np.count_nonzero((conflict_ranks > user_ranks) & conflict_valid, axis=2)
+        equal = equal - np.count_nonzero((conflict_ranks == user_ranks) & conflict_valid, axis=2)
+
+        wins += np.where(valid, worse, 0).sum(axis=0)
+        ties += np.where(valid, equal, 0).sum(axis=0)
+        user_types = sim_engine.RANK_HAND_TYPES[chunk_ranks] + np.arange(len(live)) * sim_engine.NUM_HAND_TYPES
+        hand_types += np.bincount(user_types[valid], minlength=len(hand_types))
+
+    keys = get_flop_key(holding_ids[live], np.broadcast_to(flop_ids, (len(live), 3)))
+    keys, first = np.unique(keys, return_index=True)
+    records = np.zeros(len(keys), dtype=FLOP_RECORD)
+    records['key'] = keys
+    records['wins'] = wins[first]
+    records['ties'] = ties[first]
+    records['hand_types'] = hand_types.reshape(len(live), sim_engine.NUM_HAND_TYPES)[first]
+    return records
+
+def get_flop_part_path(flop_ids, checkpoint_dir=FLOP_CHECKPOINT_DIR):
+    """Function that returns the path of a canonical flop's finished part in a checkpoint directory"""
+    return os.path.join(checkpoint_dir, '-'.join(str(card_id) for card_id in flop_ids) + '.npy')
+
+def run_flop_part(flop_ids, checkpoint_dir=FLOP_CHECKPOINT_DIR):
+    """Function that computes a canonical flop's records in a pool worker, saves them as the flop's part and returns their number.
+        The part is written to a temporary file and renamed, so an interrupted build never leaves a partial one."""
+    records = compute_flop_equity(flop_ids)
+    path = get_flop_part_path(flop_ids, checkpoint_dir)
+    with open(path + '.tmp', 'wb') as part_file:
+        np.save(part_file, records)
+    os.replace(path + '.tmp', path)
+    return len(records)
+
+def build_flop_table(workers=None, path=FLOP_TABLE_PATH, checkpoint_dir=FLOP_CHECKPOINT_DIR, flops=None):
+    """Function that computes the exact heads-up equity of every canonical (hole cards, flop) pair against a random opponent (in
+        parallel, one canonical flop per task) and writes their FLOP_RECORD records to a table sorted by key.
+        Every finished flop is saved to checkpoint_dir, so an interrupted build resumes where it stopped when run again.
+        flops limits the build to some canonical flops (see get_canonical_flops); pairs on the others are left out of the table."""
+    if flops is None:
+        flops = get_canonical_flops()
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    remaining = [flop_ids for flop_ids in flops if not os.path.exists(get_flop_part_path(flop_ids, checkpoint_dir))]
+    print(str(len(flops) - len(remaining)) + " of " + str(len(flops)) + " flops already done")
+
+    if remaining:
+        pool = sim_engine.create_pool(workers)
+        try:
+            futures = {pool.submit(run_flop_part, flop_ids, checkpoint_dir): flop_ids for flop_ids in remaining}
+            for count, future in enumerate(as_completed(futures), len(flops) - len(remaining) + 1):
+                future.result()
+                print(' '.join(hldm.int_to_card(card_id).name_short for card_id in futures[future]) + " done (" + str(count) + " of " + str(len(flops)) + ")")
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    records = np.concatenate([np.load(get_flop_part_path(flop_ids, checkpoint_dir)) for flop_ids in flops])
+    records = records[np.unique(records['key'], return_index=True)[1]]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as table_file:
+        np.save(table_file, records)
+    os.replace(path + '.tmp', path) # a process with the old table mapped keeps reading it
+    return len(records)
+
+class FlopTable:
+    """Class that answers heads-up flop scenarios (2 known hole cards, 3 board cards, one uniform random opponent without known cards
+        or a range) with exact totals from the precomputed flop table (memory mapped, searched by key)"""
+
+    def __init__(self, path=FLOP_TABLE_PATH):
+        self.table = np.load(path, mmap_mode='r')
+        self.keys = self.table['key']
+
+    def lookup(self, scenario):
+        """Method that returns the exact totals array for a Scenario, or None if the table doesn't cover it"""
+        if len(scenario.board_cards) != 3 or len(scenario.user.hole_cards) != 2 or len(scenario.opponents) != 1:
+            return None
+        opponent = scenario.opponents[0]
+        if opponent.hole_cards or sim_engine.get_dealt_range(opponent) is not None:
+            return None # the table assumes a random opponent
+        key = get_flop_key([[card.id for card in scenario.user.hole_cards]], [[card.id for card in scenario.board_cards]])[0]
+        position = np.searchsorted(self.keys, key)
+        if position == len(self.keys) or self.keys[position] != key:
+            return None
+        record = self.table[position]
+
+        wins, ties = int(record['wins']), int(record['ties'])
+        totals = np.zeros(sim_engine.TOTALS_SIZE, dtype=np.int64)
+        totals[:3] = FLOP_DEALS, wins, ties
+        totals[3] = wins * sim_engine.POT_SHARE_UNITS + ties * (sim_engine.POT_SHARE_UNITS // 2)
+        totals[4] = wins * sim_engine.POT_SHARE_UNITS ** 2 + ties * (sim_engine.POT_SHARE_UNITS // 2) ** 2
+        totals[5:sim_engine.REPLICATE_TOTALS] = record['hand_types'].astype(np.int64) * math.comb(52 - 7, 2)
+        return totals
+
+def get_flop_table():
+    """Function that returns the process wide FlopTable (loaded on first use), or None if the table hasn't been built
+        (or has another record layout)"""
+    global _flop_table
+    if _flop_table is None:
+        with _flop_table_lock:
+            if _flop_table is None:
+                _flop_table = FlopTable(FLOP_TABLE_PATH) if os.path.exists(FLOP_TABLE_PATH) else False
+                if _flop_table and _flop_table.table.dtype != FLOP_RECORD:
+                    _flop_table = False # another record layout; needs a rebuild
+    return _flop_table or None
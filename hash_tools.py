@@ -1,87 +1,266 @@
-import holdem_engine as hldm
-import hash_tools
 import numpy as np
-import pandas as pd
 import itertools
 import pickle
+import os
 
-def build_hash_table():
-    """Function that creates a Texas Hold'em hash lookup table for hand evaluation"""
-
-    # build a deck of cards (holdem_engine.py)
-    deck = hldm.Deck()
-
-    # generate all five card poker hand combos
-    combos = list(itertools.combinations(deck.cards, 5))
-    num_combos = len(combos)
-
-    # setup the hash table
-    hash_ids = []
-    ranks = []
-    subranks1 = []
-    subranks2 = []
-    subranks3 = []
-    subranks4 = []
-    subranks5 = []
-    count = 0
-    for combo in combos:
-        count += 1
-
-        # setup hash ids
-        prime_ids = [card.prime_id for card in combo] # each card is mapped to a unique prime number
-        hash_id = np.prod(np.array(prime_ids)) # prime ids are multiplied together to get unique combo ids
-        hash_ids.append(hash_id)
-
-        # build a poker hand object and evaluate it (holdem_engine.py)
-        hand = hldm.Hand()
-        hand.evaluate(combo)
-        ranks.append(hand.rank)
-        subranks1.append(hand.subranks[0])
-        subranks2.append(hand.subranks[1])
-        subranks3.append(hand.subranks[2])
-        subranks4.append(hand.subranks[3])
-        subranks5.append(hand.subranks[4])
-        print(str(round(count / num_combos * 100,4)) + "% Complete")
+# additive rank keys; any 7 card rank multiset (max four of a rank) sums to a unique value
+RANK_KEYS = [0, 1, 5, 22, 98, 453, 2031, 8698, 22854, 83661, 262349, 636345, 1479181]
+RANK_KEY_BITS = 23 # the largest 7 card rank key sum (7,825,759) fits in 23 bits
 
-    print("")
-    print("Preparing hash table...")
+TABLE_DIR = 'lookup_tables' # directory holding the binary (.npy) lookup tables
+
+# hand types in Hand.rank order (1 = Royal Flush ... 10 = High Card) and the highest universal rank of each type.
+# No 5 card hand is typed 'Full House' by Hand.evaluate (trips plus a pair is typed 'Three of a Kind'), so that type is empty.
+HAND_TYPES = ['Royal Flush', 'Straight Flush', 'Four of a Kind', 'Full House', 'Flush', 'Straight', 'Three of a Kind', 'Two Pair',
+              'One Pair', 'High Card']
+HAND_TYPE_LIMITS = [0, 9, 165, 165, 1442, 1452, 2466, 3324, 6184, 7461]
 
-    hash_dict = {
-        'hash_id': hash_ids,
-        'rank': ranks, 
-        'subrank1':subranks1,
-        'subrank2':subranks2, 
-        'subrank3':subranks3, 
-        'subrank4':subranks4, 
-        'subrank5':subranks5
-    }
-    
-    hash_df = pd.DataFrame(hash_dict)
+def build_hash_table(table_dir=TABLE_DIR, write_csv=False, chunk_size=250000):
+    """Function that creates a Texas Hold'em hash lookup table for hand evaluation.
+        All 2,598,960 five card combos are ranked as integer arrays (rank_five_card_hands) in chunks, so a rebuild takes seconds."""
 
-    # sort the hash df by rank and subranks of each hand
-    hash_df = hash_df.sort_values(['rank','subrank1','subrank2','subrank3','subrank4','subrank5'])
+    # generate all five card poker hand combos as card indices (Card id - 1)
+    num_combos = 2598960
+    combos = np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(52), 5)), dtype=np.int64,
+                         count=5 * num_combos).reshape(num_combos, 5)
 
-    #combine rank columns into concatenated string values
-    hash_df['combined'] = hash_df[['rank','subrank1','subrank2','subrank3','subrank4','subrank5']].apply(
-                 lambda x: '_'.join(map(str, x)), axis=1)
+    # setup hash ids; each card is mapped to a unique prime number and prime ids are multiplied together to get unique combo ids
+    primes = np.array(get_primes(), dtype=np.uint64)
+    hash_ids = np.empty(num_combos, dtype=np.uint64)
+    ranks = np.empty(num_combos, dtype=np.int64)
+    subranks = np.empty((num_combos, 5), dtype=np.int64)
+    for start in range(0, num_combos, chunk_size):
+        chunk = combos[start:start + chunk_size]
+        hash_ids[start:start + chunk_size] = primes[chunk].prod(axis=1)
+        ranks[start:start + chunk_size], subranks[start:start + chunk_size] = rank_five_card_hands(chunk)
+        print(str(round(min(start + chunk_size, num_combos) / num_combos * 100, 1)) + "% Complete")
 
-    # assign 'univeral ranks' to each unique 'combined' rank value and write them to a new column
-    hash_df['universal_rank'] = pd.factorize(hash_df.combined)[0] #pd.factorize doing the heavy lifting here
+    print("")
+    print("Preparing hash table...")
 
-    # genarate dictionary mapping hash ids to their respective universal ranks
-    hash_dict = dict(zip(hash_df['hash_id'], hash_df['universal_rank']))
+    # assign 'universal ranks' by sorting a numeric (rank, subrank1..5) key; ordinals are below 16 so each fits in 4 bits
+    sort_keys = ranks
+    for column in range(5):
+        sort_keys = sort_keys * 16 + subranks[:, column]
+    universal_ranks = np.unique(sort_keys, return_inverse=True)[1]
 
     print("")
     print("Writing table to file...")
 
-    # write hash_dict to a 'pickle' file (for efficient importing into other modules) and to a csv (for viewing/testing)
-    filehandler = open('hash_lookup.pickle', 'wb')
-    pickle.dump(hash_dict, filehandler)
-    hash_df.to_csv('poker_hash_lookup.csv', index=False)
+    # write the table as sorted binary key/rank arrays (for memory mapping into other modules) and optionally to a csv (for viewing/testing)
+    write_hash_table(hash_ids, universal_ranks, table_dir)
+    if write_csv:
+        import pandas as pd
+        hash_df = pd.DataFrame({'hash_id': hash_ids, 'rank': ranks, 'subrank1': subranks[:, 0], 'subrank2': subranks[:, 1],
+                                'subrank3': subranks[:, 2], 'subrank4': subranks[:, 3], 'subrank5': subranks[:, 4],
+                                'universal_rank': universal_ranks})
+        hash_df.sort_values('universal_rank').to_csv('poker_hash_lookup.csv', index=False)
 
     print("")
     print("Done!")
 
+def rank_five_card_hands(combos):
+    """Function that takes in an (n, 5) array of card indices (Card id - 1) and returns the hand rank (n array) and subranks
+        ((n, 5) array of ordinals) that holdem_engine.Hand.evaluate assigns to each 5 card hand"""
+    values = combos // 4 # 0 = Two ... 12 = Ace
+    suits = combos % 4
+    ordinals = 13 - values # 1 = Ace ... 13 = Two (holdem_engine ordinals)
+
+    # subranks list the most repeated values first, then higher values first
+    counts = (values[:, :, np.newaxis] == values[:, np.newaxis, :]).sum(axis=2)
+    subranks = np.sort((5 - counts) * 16 + ordinals, axis=1) % 16
+
+    max_count = counts.max(axis=1)
+    num_pairs = (counts == 2).sum(axis=1) // 2
+    is_flush = (suits == suits[:, :1]).all(axis=1)
+    high, low = values.max(axis=1), values.min(axis=1)
+    is_wheel = (max_count == 1) & (high == 12) & (subranks[:, 1] == 10) # A-5-4-3-2
+    is_straight = (max_count == 1) & ((high - low == 4) | is_wheel)
+    subranks[is_wheel] = [10, 11, 12, 13, 1] # the ace plays low
+
+    # hand ranks as assigned by Hand.evaluate; a 5 card full house is checked as 'Three of a Kind' there, so it is here too
+    ranks = np.select([is_flush & is_straight & (high == 12) & ~is_wheel, is_flush & is_straight, max_count == 4, is_flush,
+                       is_straight, max_count == 3, num_pairs == 2, num_pairs == 1], [1, 2, 3, 5, 6, 7, 8, 9], 10)
+
+    return ranks, subranks
+
+def verify_hash_table(path='hash_lookup.pickle', table_dir=TABLE_DIR):
+    """Function that checks the binary hash lookup table against a pickled hash lookup dict (e.g. one built by an older version)
+        and returns True if both map exactly the same hash ids to the same universal ranks"""
+    with open(path, 'rb') as handle:
+        hash_dict = pickle.load(handle)
+    hash_table = HashTable(table_dir)
+
+    hash_ids = np.array(list(hash_dict.keys()), dtype=np.uint64)
+    expected = np.array(list(hash_dict.values()))
+    indices = np.minimum(np.searchsorted(hash_table.hash_ids, hash_ids), len(hash_table.hash_ids) - 1)
+    matches = (len(hash_table.hash_ids) == len(hash_ids)) & (hash_table.hash_ids[indices] == hash_ids) & (hash_table.ranks[indices] == expected)
+
+    print(str(int(matches.sum())) + " of " + str(len(hash_ids)) + " hash ids match")
+    return bool(matches.all())
+
+def write_hash_table(hash_ids, universal_ranks, table_dir=TABLE_DIR):
+    """Function that writes the 5 card hash lookup table as a sorted uint64 hash id array plus a uint16 universal rank array"""
+    hash_ids = np.asarray(hash_ids, dtype=np.uint64)
+    order = np.argsort(hash_ids)
+    write_table('hash_ids', hash_ids[order], table_dir)
+    write_table('hash_ranks', np.asarray(universal_ranks, dtype=np.uint16)[order], table_dir)
+
+def convert_hash_table(path='hash_lookup.pickle', table_dir=TABLE_DIR):
+    """Function that converts a hash lookup dict pickled by older versions of build_hash_table to the binary format"""
+    with open(path, 'rb') as handle:
+        hash_dict = pickle.load(handle)
+    write_hash_table(list(hash_dict.keys()), list(hash_dict.values()), table_dir)
+
+def write_table(name, table, table_dir=TABLE_DIR):
+    """Function that writes a lookup table (NumPy array) to table_dir/name.npy"""
+    os.makedirs(table_dir, exist_ok=True)
+    np.save(os.path.join(table_dir, name + '.npy'), table)
+
+def load_table(name, table_dir=TABLE_DIR):
+    """Function that memory maps a lookup table written by write_table (read only; pages are shared by every process)"""
+    return np.load(os.path.join(table_dir, name + '.npy'), mmap_mode='r')
+
+class HashTable:
+    """Class that looks up 5 card hash ids (products of Card prime ids) in the memory mapped hash lookup table"""
+
+    def __init__(self, table_dir=TABLE_DIR):
+        self.hash_ids = load_table('hash_ids', table_dir)
+        self.ranks = load_table('hash_ranks', table_dir)
+
+    def __getitem__(self, hash_id):
+        """Method that returns the universal rank (int) of a single hash id"""
+        index = int(np.searchsorted(self.hash_ids, hash_id))
+        if index == len(self.hash_ids) or self.hash_ids[index] != hash_id:
+            raise KeyError(hash_id)
+        return int(self.ranks[index])
+
+    def lookup(self, hash_ids):
+        """Method that returns the universal ranks (array) of an array of hash ids (all ids must be valid)"""
+        return self.ranks[np.searchsorted(self.hash_ids, np.asarray(hash_ids, dtype=np.uint64))]
+
+def build_evaluator_table(hash_table=None, table_dir=TABLE_DIR):
+    """Function that builds the direct 7 card evaluation tables (used by Evaluator) from the 5 card hash lookup table.
+        Every entry is the best (lowest) universal rank among the 21 five card combos, so ordering is identical to get_score."""
+
+    if hash_table is None:
+        hash_table = HashTable(table_dir)
+
+    primes = get_primes()
+
+    def combo_hash_ids(ranks, flush):
+        """Returns the hash ids of every 5 card combo of a rank multiset (0 = Two ... 12 = Ace).
+            Suits are dealt round robin over the sorted ranks (never repeats a card or makes a flush) unless flush is True."""
+        hash_ids = []
+        for combo in itertools.combinations(sorted(ranks), 5):
+            hash_id = 1
+            for index, rank in enumerate(combo):
+                hash_id *= primes[4 * rank + (0 if flush else index % 4)]
+            hash_ids.append(hash_id)
+        return hash_ids
+
+    # non flush hands only depend on the rank multiset of the 7 cards
+    print("Building rank table...")
+    rank_multisets = []
+    def add_rank_multisets(rank, ranks):
+        if len(ranks) == 7:
+            rank_multisets.append(ranks)
+        elif rank <= 12:
+            for count in range(min(4, 7 - len(ranks)) + 1):
+                add_rank_multisets(rank + 1, ranks + [rank] * count)
+    add_rank_multisets(0, [])
+
+    rank_keys = [sum(RANK_KEYS[rank] for rank in ranks) for ranks in rank_multisets]
+    hash_ids = [combo_hash_ids(ranks, False) for ranks in rank_multisets]
+    rank_table = np.zeros(4 * RANK_KEYS[12] + 3 * RANK_KEYS[11] + 1, dtype=np.uint16)
+    rank_table[rank_keys] = hash_table.lookup(hash_ids).min(axis=1)
+
+    # flush hands are scored from the 13 bit rank mask of the flush suit (7 cards can't hold a flush and a full house/quads)
+    print("Building flush table...")
+    flush_table = np.zeros(8192, dtype=np.uint16)
+    for mask in range(8192):
+        ranks = [rank for rank in range(13) if mask >> rank & 1]
+        if len(ranks) >= 5:
+            flush_table[mask] = hash_table.lookup(combo_hash_ids(ranks, True)).min()
+
+    print("Writing table to file...")
+    write_table('rank_table', rank_table, table_dir)
+    write_table('flush_table', flush_table, table_dir)
+
+    print("Done!")
+
+class Evaluator:
+    """Class that scores 7 card hands with a handful of table lookups.  Cards are passed as Card ids (1-52, see holdem_engine.Deck)
+        and scores are universal ranks (lower is better), exactly as returned by the 21 combination hash lookup."""
+
+    def __init__(self, table_dir=TABLE_DIR):
+        # the tables are memory mapped (near zero load time, shared by all processes); the memoryviews give fast scalar indexing
+        self.rank_table_array = load_table('rank_table', table_dir)
+        self.flush_table_array = load_table('flush_table', table_dir)
+        self.rank_table = memoryview(self.rank_table_array)
+        self.flush_table = memoryview(self.flush_table_array)
+
+        # per card keys (index 0 is unused so Card ids can be used directly)
+        # card_keys packs the rank key (low bits) with a 3 bit per suit counter (high bits)
+        # flush_keys places each card's rank bit in a 13 bit block per suit
+        self.card_keys = [0]
+        self.flush_keys = [0]
+        for index in range(52):
+            rank, suit = divmod(index, 4)
+            self.card_keys.append(RANK_KEYS[rank] + (1 << (RANK_KEY_BITS + 3 * suit)))
+            self.flush_keys.append(1 << (13 * suit + rank))
+
+        # maps the packed suit counters to the flush suit (-1 if there is no flush)
+        self.flush_suit = [-1] * 4096
+        for suit_key in range(4096):
+            for suit in range(4):
+                if suit_key >> (3 * suit) & 7 >= 5:
+                    self.flush_suit[suit_key] = suit
+
+        # NumPy copies of the small key tables for evaluate_batch
+        self.card_keys_array = np.array(self.card_keys, dtype=np.int64)
+        self.flush_keys_array = np.array(self.flush_keys, dtype=np.int64)
+        self.flush_suit_array = np.array(self.flush_suit, dtype=np.int64)
+
+    def evaluate(self, card_ids):
+        """Method that takes in 7 Card ids (list) and returns the hand score (int)"""
+        card_keys = self.card_keys
+        key = 0
+        for card_id in card_ids:
+            key += card_keys[card_id]
+
+        suit = self.flush_suit[key >> RANK_KEY_BITS]
+        if suit < 0:
+            return self.rank_table[key & ((1 << RANK_KEY_BITS) - 1)]
+
+        flush_keys = self.flush_keys
+        flush_key = 0
+        for card_id in card_ids:
+            flush_key += flush_keys[card_id]
+        return self.flush_table[flush_key >> (13 * suit) & 8191]
+
+    def evaluate_batch(self, card_ids):
+        """Method that takes in an (n, 7) integer array of Card ids (one hand per row) and returns an array of n hand scores"""
+        card_ids = np.asarray(card_ids)
+        keys = self.card_keys_array[card_ids].sum(axis=1)
+        suits = self.flush_suit_array[keys >> RANK_KEY_BITS]
+        scores = self.rank_table_array[keys & ((1 << RANK_KEY_BITS) - 1)]
+
+        flush = suits >= 0
+        if flush.any():
+            flush_keys = self.flush_keys_array[card_ids[flush]].sum(axis=1)
+            scores[flush] = self.flush_table_array[flush_keys >> (13 * suits[flush]) & 8191]
+
+        return scores
+
+    def evaluate_cards(self, cards):
+        """Method that takes in 7 Card objects (list) and returns the hand score (int)"""
+        return self.evaluate([card.id for card in cards])
+
+def get_rank_hand_types():
+    """Function that returns an array mapping each universal rank (0-7461) to its hand type (index into HAND_TYPES)"""
+    return np.searchsorted(HAND_TYPE_LIMITS, np.arange(HAND_TYPE_LIMITS[-1] + 1)).astype(np.int64)
+
 def get_primes():
     """ Function that returns the first 52 prime numbers in a list"""
     primes = []
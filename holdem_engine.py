@@ -2,8 +2,20 @@ import random
 import hash_tools
 from collections import Counter
 
+# card masks: a Card with id n (1-52) is bit n; shifted down by one, each value (0 = Two ... 12 = Ace) owns a 4 bit nibble, one bit per suit
+NIBBLES_0001 = int('1' * 13, 16)
+NIBBLES_0011 = NIBBLES_0001 * 3
+NIBBLES_0101 = NIBBLES_0001 * 5
+STRAIGHTS = [(0x11111 << 4 * (top - 4), list(range(top, top - 5, -1))) for top in range(12, 3, -1)] # Ace high down to Six high
+STRAIGHTS.append((0x1000000001111, [3, 2, 1, 0, 12])) # adding in ace-low straight
+
+VALUE_CHARS = '23456789TJQKA' # value initials (Two ... Ace) used in card strings and range notation
+SUIT_CHARS = 'SDCH' # suit initials in Card suit order (Spades, Diamonds, Clubs, Hearts)
+
 class Card:
     """Class representing a standard playing card.  It contains the following attributes: suit, value, ordinal, name."""
+    __slots__ = ('id', 'prime_id', 'suit', 'value', 'value_plural', 'ordinal', 'name_short', 'name', 'shorthand')
+
     def __init__(self, suit, value, value_plural, ordinal, card_id, prime_id, name_short):
         self.id = card_id
         self.prime_id = prime_id # for hash lookups
@@ -25,55 +37,177 @@ class Card:
         self.shorthand = str()
 
 class Deck:
-    """Class representing a deck of cards.  It houses the following attributes: cards.  The class also has the following methods: draw_card, shuffle."""
+    """Class representing a deck of cards.  It houses the following attributes: cards.  The class also has the following methods: draw_card, shuffle.
+        The deck is stored as a list of Card ids with a cursor: cards still in the deck are ids[position:size], drawn or burnt cards
+        sit before the cursor and removed (dead) cards after size, so drawing, burning and removing are all O(1)."""
     def __init__(self):
-        """Contructor function that creates a list attribute 'cards' and calls the build_deck method to build the deck of cards."""
-        self.cards = []
+        """Contructor function that creates the id list and calls the build method to build the deck of cards."""
+        self.ids = []
+        self.index = [] # index[card_id] = position of that card in ids
+        self.position = 0
+        self.size = 0
         self.build()
 
     def build(self):
-        """Method that builds a deck of cards (where each card belongs to the class Card)."""
-        self.cards = [] # clear list of cards
-        suits = ["Spades", "Diamonds", "Clubs", "Hearts"]
-        values = ["Two", "Three", "Four", "Five", "Six", "Seven", "Eight", "Nine", "Ten", "Jack", "Queen", "King", "Ace"]
-        short_values = ["2","3","4","5","6","7","8","9","10","J","Q","K","A"]
-        values_plural = ["Twos", "Threes", "Fours", "Fives", "Sixes", "Sevens", "Eights", "Nines", "Tens", "Jacks", "Queens", "Kings", "Aces"]
-        values_ordinal = [13,12,11,10,9,8,7,6,5,4,3,2,1]
-        prime_ids = hash_tools.get_primes()
-        id_count = 0
-        for index, value in enumerate(values):
-            for suit in suits:
-                prime_id = prime_ids[id_count]
-                id_count += 1
-                suit = suit
-                value = value
-                value_plural = values_plural[index]
-                value_ordinal = values_ordinal[index]
-                name_short = short_values[index] + suit[0]
-                self.cards.append(Card(suit, value, value_plural, value_ordinal, id_count, prime_id, name_short))
-
-    def shuffle(self):
-        """Method that randomly shuffles the deck."""
-        random.shuffle(self.cards)
+        """Method that builds a deck of cards (where each card belongs to the class Card).  The 52 Card objects are shared by every deck (see CARDS)."""
+        self.ids = list(range(1, 53))
+        self.index = list(range(-1, 52))
+        self.position = 0
+        self.size = 52
+
+    @property
+    def cards(self):
+        """List of the Cards still in the deck, top card first"""
+        return [CARDS[card_id - 1] for card_id in self.ids[self.position:self.size]]
+
+    def reset(self, keep_removed=True):
+        """Method that puts the drawn and burnt cards back in the deck (and the removed cards too, unless keep_removed) so it can be reused
+            for another deal.  The cards keep their current order; call shuffle before dealing again."""
+        self.position = 0
+        if keep_removed is False:
+            self.size = 52
+
+    def shuffle(self, num_cards=None, rndm=random):
+        """Method that randomly shuffles the deck.  If num_cards is given only the top num_cards are drawn at random
+            (a partial Fisher-Yates shuffle), which is all that is needed to deal that many cards."""
+        ids, index, end = self.ids, self.index, self.size
+        stop = end if num_cards is None else min(self.position + num_cards, end)
+        for i in range(self.position, stop):
+            j = rndm.randrange(i, end)
+            ids[i], ids[j] = ids[j], ids[i]
+            index[ids[i]] = i
+            index[ids[j]] = j
 
     def draw_card(self):
-        """Method that draws a card from the top of the deck (first card in list representing the deck).
-            The function returns the card it drew."""
-        card = self.cards.pop(0)
-        return card
+        """Method that draws a card from the top of the deck (the card at the cursor).
+            The function returns the card it drew.  Raises IndexError if the deck is empty."""
+        if self.position >= self.size: # (the ids past size are removed cards)
+            raise IndexError("Draw from an empty deck")
+        card_id = self.ids[self.position]
+        self.position += 1
+        return CARDS[card_id - 1]
+
+    def draw_ids(self, num_cards):
+        """Method that draws num_cards cards from the top of the deck and returns their Card ids.  Raises IndexError if fewer are left."""
+        if self.position + num_cards > self.size:
+            raise IndexError("Draw of " + str(num_cards) + " cards from a deck with " + str(self.size - self.position) + " left")
+        card_ids = self.ids[self.position:self.position + num_cards]
+        self.position += num_cards
+        return card_ids
 
     def burn_card(self):
-        """Method that removes a card from the top of the deck (first card in the list representing the deck). The function returns nothing."""
-        del self.cards[0]
+        """Method that removes a card from the top of the deck (moves the cursor past it). The function returns nothing.
+            Raises IndexError if the deck is empty."""
+        if self.position >= self.size:
+            raise IndexError("Burn from an empty deck")
+        self.position += 1
 
     def remove_card(self, card_to_remove):
-        """Method that removes a specific card from the Deck.  Takes in a list of Card objects as an input"""
-        [self.cards.remove(card) for card in self.cards if card.id == card_to_remove.id]
+        """Method that removes a specific card from the Deck by swapping it with the last card still in the deck.  Takes in a Card object as an input"""
+        ids, index = self.ids, self.index
+        i = index[card_to_remove.id]
+        if self.position <= i < self.size:
+            self.size -= 1
+            last = self.size
+            ids[i], ids[last] = ids[last], ids[i]
+            index[ids[i]] = i
+            index[ids[last]] = last
+
+
+def build_cards():
+    """Function that builds the 52 Card objects of a deck, in Card id order"""
+    cards = []
+    suits = ["Spades", "Diamonds", "Clubs", "Hearts"]
+    values = ["Two", "Three", "Four", "Five", "Six", "Seven", "Eight", "Nine", "Ten", "Jack", "Queen", "King", "Ace"]
+    short_values = ["2","3","4","5","6","7","8","9","10","J","Q","K","A"]
+    values_plural = ["Twos", "Threes", "Fours", "Fives", "Sixes", "Sevens", "Eights", "Nines", "Tens", "Jacks", "Queens", "Kings", "Aces"]
+    values_ordinal = [13,12,11,10,9,8,7,6,5,4,3,2,1]
+    prime_ids = hash_tools.get_primes()
+    id_count = 0
+    for index, value in enumerate(values):
+        for suit in suits:
+            prime_id = prime_ids[id_count]
+            id_count += 1
+            value_plural = values_plural[index]
+            value_ordinal = values_ordinal[index]
+            name_short = short_values[index] + suit[0]
+            cards.append(Card(suit, value, value_plural, value_ordinal, id_count, prime_id, name_short))
+    return tuple(cards)
+
+CARDS = build_cards() # shared Card objects; CARDS[card_id - 1] is the Card with that id
+NIBBLE_CARDS = [[[CARDS[4 * value + suit] for suit in range(4) if nibble >> suit & 1] for nibble in range(16)] for value in range(13)]
+
+def card_to_int(card):
+    """Function that returns the small int (Card id, 1-52) representing a Card"""
+    return card.id
+
+def int_to_card(card_id):
+    """Function that returns the (shared) Card object for a Card id"""
+    return CARDS[card_id - 1]
+
+def str_to_card(text):
+    """Function that returns the (shared) Card named by a short string: value initial then suit initial, e.g. 'As', 'Td' or '10h' (any case)"""
+    name = text.strip().upper().replace('10', 'T')
+    if len(name) != 2 or name[0] not in VALUE_CHARS or name[1] not in SUIT_CHARS:
+        raise ValueError("Invalid card: " + repr(text))
+    return CARDS[4 * VALUE_CHARS.index(name[0]) + SUIT_CHARS.index(name[1])]
+
+def str_to_cards(text):
+    """Function that returns the Cards named in a string of short card names, with or without separators (e.g. 'AsKd', 'Qh 7h 2c', '10h,9h')"""
+    name = text.replace(',', '').replace(' ', '').strip()
+    cards = []
+    i = 0
+    while i < len(name):
+        size = 3 if name.startswith('10', i) else 2
+        cards.append(str_to_card(name[i:i + size]))
+        i += size
+    return cards
+
+def cards_to_mask(cards):
+    """Function that takes in a list of Cards and returns a 64 bit int with bit card.id set for each card"""
+    mask = 0
+    for card in cards:
+        mask |= 1 << card.id
+    return mask
+
+def mask_to_cards(mask):
+    """Function that takes in a card mask (see cards_to_mask) and returns its Cards in Card id order"""
+    return [CARDS[card_id - 1] for card_id in range(1, 53) if mask >> card_id & 1]
+
+def get_hand_class(card_ids):
+    """Function that takes in 2 hole Card ids and returns the index (0-168) of their starting hand class.
+        The classes form a 13x13 grid: pairs on the diagonal, suited hands above it and offsuit hands below it."""
+    high, low = max(card_ids), min(card_ids)
+    high_value, low_value = (high - 1) // 4, (low - 1) // 4
+    if (high - 1) % 4 == (low - 1) % 4: # suited
+        return high_value * 13 + low_value
+    return low_value * 13 + high_value
+
+def get_straight(present):
+    """Function that takes in value presence flags (lowest bit of each value's nibble) and returns the values of the best straight
+        in straight order (list of value indices), or None"""
+    for pattern, values in STRAIGHTS:
+        if present & pattern == pattern:
+            return values
+    return None
+
+def order_mask(bits, first_bits, value_cards=NIBBLE_CARDS):
+    """Function that returns the best five Cards of a (shifted) card mask: the cards in first_bits, then the rest,
+        each from high to low value, like Hand.keep_five.  value_cards[value][nibble] gives the Cards of a value
+        (in suit order by default)"""
+    cards = []
+    for group in (bits & first_bits, bits & ~first_bits):
+        while group and len(cards) < 5:
+            shift = (group.bit_length() - 1) & ~3 # 4 * value of the highest card
+            cards += value_cards[shift >> 2][group >> shift & 15]
+            group &= ~(15 << shift)
+    return cards[:5]
 
 
 class Player:
     """Class representing a player at the table.
         Player objects have the following attributes: name (str), stack (float), hole_cards (list)."""
+    __slots__ = ('name', 'stack', 'betting_pos', 'hole_cards', 'available_cards', 'hand', 'range')
 
     def __init__(self):
         self.name = str()
@@ -102,6 +236,7 @@ class Player:
 class Hand:
     """Class that represents a poker hand.  Hand objects have the following attributes: evaluated (Boolean intitialized to False), cards (list of Cards), kickers (list of Cards), type (str), name (str), rank (int),
         subranks (list of ints), kickers_ordinals (list of ints)"""
+    __slots__ = ('evaluated', 'cards', 'kickers', 'type', 'name', 'rank', 'subranks', 'score', 'kickers_ordinals')
 
     def __init__(self):
         self.evaluated = False
@@ -115,7 +250,13 @@ class Hand:
         self.kickers_ordinals = []
 
     def evaluate(self, cards):
-        """Method that evaluates a list of Cards (input_cards) and updates the hand object attributes accordingly"""
+        """Method that evaluates a list of Cards (input_cards) and updates the hand object attributes accordingly.
+            Single pass: the value counts, suit counts and straights are found once on the card mask (see evaluate_mask)."""
+        self.evaluate_mask(cards_to_mask(cards), cards)
+
+    def evaluate_sequential(self, cards):
+        """Method that evaluates a list of Cards by running the seven check_* methods in turn (the original evaluator,
+            kept as the reference that evaluate is tested against)"""
 
         evals = [self.check_straightflush_royalflush, self.check_fourofakind, self.check_fullhouse, self.check_flush,
                  self.check_straight, self.check_combos, self.assign_nohand]
@@ -125,6 +266,118 @@ class Hand:
             if self.evaluated is True:
                 break
 
+    def evaluate_mask(self, mask, cards=None):
+        """Method that evaluates a hand given as a card mask (see cards_to_mask) and updates the hand object attributes accordingly.
+            The result is the same as evaluate_sequential(mask_to_cards(mask)), but ranks are counted with bit operations on the mask
+            (4 bits per value, one per suit) instead of Card comparisons, and only the chosen cards are turned into Card objects.
+            If the same cards are given as a list (cards), cards of equal value are kept in that list's order, as evaluate_sequential does."""
+        bits = mask >> 1 # bit 4 * value + suit for each card (value 0 = Two ... 12 = Ace)
+
+        # per value card counts, each flag set in the lowest bit of the value's nibble
+        counts = bits - ((bits >> 1) & NIBBLES_0101)
+        counts = (counts & NIBBLES_0011) + ((counts >> 2) & NIBBLES_0011)
+        present = (counts | counts >> 1 | counts >> 2) & NIBBLES_0001
+        quads = counts >> 2 & NIBBLES_0001
+        trips = counts & counts >> 1 & NIBBLES_0001
+        pairs = counts >> 1 & ~counts & NIBBLES_0001
+        value_cards = NIBBLE_CARDS
+        if cards is not None and quads | trips | pairs: # some value has 2+ cards, so their input order matters
+            value_cards = list(NIBBLE_CARDS)
+            multiples = quads | trips | pairs
+            while multiples:
+                shift = (multiples.bit_length() - 1) & ~3
+                value_row = value_cards[shift >> 2] = list(NIBBLE_CARDS[shift >> 2])
+                value_row[bits >> shift & 15] = [card for card in cards if (card.id - 1) >> 2 << 2 == shift]
+                multiples &= ~(15 << shift)
+        num_trips = (trips * NIBBLES_0001) >> 48 & 15 # multiplying by NIBBLES_0001 sums the 13 nibbles into the top one
+        num_pairs = (pairs * NIBBLES_0001) >> 48 & 15
+
+        flush_suits = [suit for suit in range(4) if (bits >> suit & NIBBLES_0001) * NIBBLES_0001 >> 48 & 15 >= 5]
+        flush_suit = flush_suits[0] if len(flush_suits) == 1 else None
+
+        straight_flush = None
+        if flush_suit is not None:
+            straight_flush = get_straight(bits >> flush_suit & NIBBLES_0001)
+
+        if straight_flush is not None:
+            self.cards = [CARDS[4 * value + flush_suit] for value in straight_flush]
+            self.kickers = None
+            if self.cards[0].value == "Ace":
+                self.type = 'Royal Flush'
+                self.name = self.type + ' of ' + self.cards[0].suit
+                self.rank = 1
+            else:
+                self.type = 'Straight Flush'
+                self.name = self.type + ' of ' + self.cards[0].suit + ', ' + self.cards[0].value + ' High'
+                self.rank = 2
+        elif quads:
+            self.cards = order_mask(bits, quads * 15, value_cards)
+            self.kickers = self.cards[4:]
+            self.type = 'Four of a Kind'
+            self.name = self.type + ', ' + self.cards[0].value_plural
+            self.rank = 3
+        elif num_trips > 1 or (num_trips == 1 and num_pairs > 1):
+            # only the trips cards, then the pairs cards (order_mask would pad the trips with kickers when there are 8+ cards)
+            self.cards = (order_mask(bits & trips * 15, trips * 15, value_cards) + order_mask(bits & pairs * 15, pairs * 15, value_cards))[:5]
+            self.kickers = None
+            self.type = 'Full House'
+            self.name = self.type + ', ' + self.cards[0].value_plural + ' Full of ' + self.cards[3].value
+            self.rank = 4
+        elif flush_suit is not None:
+            self.cards = order_mask(bits, NIBBLES_0001 << flush_suit)
+            self.kickers = None
+            self.type = 'Flush'
+            self.name = self.type + ' of ' + self.cards[0].suit + ', ' + self.cards[0].value + ' High'
+            self.rank = 5
+        elif get_straight(present) is not None:
+            straight_cards = []
+            for value in get_straight(present):
+                straight_cards += value_cards[value][bits >> 4 * value & 15]
+            self.cards = self.dedupe_straight(straight_cards)
+            self.kickers = None
+            self.type = 'Straight'
+            self.name = self.type + ', ' + self.cards[0].value + ' High'
+            self.rank = 6
+        elif num_trips:
+            self.cards = order_mask(bits, trips * 15, value_cards)
+            self.kickers = self.cards[3:]
+            self.type = 'Three of a Kind'
+            self.name = self.type + ', ' + self.cards[0].value_plural
+            self.rank = 7
+        elif num_pairs >= 2:
+            self.cards = order_mask(bits, pairs * 15, value_cards)
+            self.kickers = self.cards[4:]
+            self.type = 'Two Pair'
+            self.name = self.type + ', ' + self.cards[0].value_plural + ' and ' + self.cards[2].value_plural
+            self.rank = 8
+        elif num_pairs == 1:
+            self.cards = order_mask(bits, pairs * 15, value_cards)
+            self.kickers = self.cards[2:]
+            self.type = 'One Pair'
+            self.name = self.type + ' of ' + self.cards[0].value_plural
+            self.rank = 9
+        else:
+            self.cards = order_mask(bits, 0)
+            self.kickers = None
+            self.type = 'High Card'
+            self.name = self.type + ', ' + self.cards[0].name
+            self.rank = 10
+
+        self.evaluated = True
+        self.subranks = [card.ordinal for card in self.cards]
+        self.kickers_ordinals = None if self.kickers is None else [card.ordinal for card in self.kickers]
+
+    @staticmethod
+    def dedupe_straight(straight_cards):
+        """Function that keeps one card per value of a straight (list of Cards in straight order), exactly as check_straight does"""
+        my_straight = list(straight_cards)
+        my_st_ordinals = [card.ordinal for card in my_straight]
+        for card in my_straight: # keep only 5 straight cards
+            if my_st_ordinals.count(card.ordinal) > 1:
+                my_straight.remove(card)
+                my_st_ordinals.remove(card.ordinal)
+        return my_straight
+
     def check_straightflush_royalflush(self, cards):
         """ Method that checks for the hand type, 'Straight Flush', and assigns appropriate attributes if true.
             Uses a list of cards (Card objects) as an input. """
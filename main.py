@@ -1,9 +1,51 @@
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
+from PyQt5.QtCore import QThread, pyqtSignal
 import holdem_engine
 import simulation_engine
 import sys
 
+GUI_CI_WIDTH = 0.01 # width of the 95% confidence interval the GUI simulates to (+/- half a percentage point)
+
+
+class SimulationWorker(QThread):
+    """Thread that runs a Simulation off the GUI thread, emitting the running estimate (trials, win probability and its 95%
+        confidence interval) after every batch and the finished Simulation (None if it failed to start) and an error message
+        ('' unless the simulation raised) at the end"""
+    progress = pyqtSignal(int, float, float, float)
+    done = pyqtSignal(object, str)
+
+    def __init__(self, scenario):
+        super().__init__()
+        self.scenario = scenario
+        self.simulation = None
+        self.cancel_requested = False
+
+    def run(self):
+        """Runs on the worker thread (started with start())"""
+        error = ''
+        try:
+            self.simulation = simulation_engine.Simulation(self.scenario) # loads the eval tables on first use
+            if self.cancel_requested:
+                self.simulation.cancel()
+            self.simulation.run(ci_width=GUI_CI_WIDTH, progress=self.report)
+        except Exception as exception: # (e.g. missing eval tables) reported by the GUI, which re-enables its controls
+            error = str(exception) or type(exception).__name__
+        self.done.emit(self.simulation, error)
+
+    def report(self, count, wins, ties):
+        """Progress callback passed to Simulation.run"""
+        win_rate = wins / count
+        low, high = simulation_engine.get_confidence_interval(win_rate, simulation_engine.get_std_error(wins, count))
+        self.progress.emit(count, win_rate, low, high)
+
+    def cancel(self):
+        """Asks the simulation to stop after its current batch"""
+        self.cancel_requested = True
+        if self.simulation is not None:
+            self.simulation.cancel()
+
+
 class App(QDialog):
 
     def __init__(self):
@@ -14,6 +56,7 @@ class App(QDialog):
         self.drop_down_menus = []
         self.selected_cards = []
         self.num_opps = 1
+        self.worker = None
         self.createCardNames()
         self.card_dict = {}
         self.createCardDict()
@@ -183,7 +226,10 @@ class App(QDialog):
         self.button.pressed.connect(lambda: self.button_pressed())
 
     def button_pressed(self):
-        """Function that runs simulation once button is pressed; returns resultant win pct estimate in a popup window"""
+        """Function that starts a simulation on a worker thread once button is pressed; the running estimate is shown below the button
+            and the resultant win pct estimate in a popup window (see simulation_done)"""
+        if self.worker is not None: # a simulation is already running
+            return
 
         board = [self.card_dict[card_name] for card_name in self.selected_cards[2:]]
 
@@ -195,15 +241,50 @@ class App(QDialog):
 
         scenario = simulation_engine.Scenario(user, opps, board)
 
-        sim = simulation_engine.Simulation(scenario)
-        sim.run()
-        result = sim.result
+        self.worker = SimulationWorker(scenario)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.done.connect(self.simulation_done)
+        self.button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_label.setText("Running simulation...")
+        self.worker.start()
+
+    def cancel_pressed(self):
+        """Function that cancels the running simulation; the estimate so far is still reported"""
+        if self.worker is not None:
+            self.progress_label.setText("Cancelling...")
+            self.worker.cancel()
+
+    def show_progress(self, count, win_rate, low, high):
+        """Function that shows the running win pct estimate and its 95% confidence interval while the simulation runs"""
+        self.progress_label.setText("Estimated Win Probability: " + str(round(win_rate * 100, 1)) + "% (95% CI " +
+                                    str(round(low * 100, 1)) + "% - " + str(round(high * 100, 1)) + "%) after " +
+                                    format(count, ',') + " trials")
+
+    def simulation_done(self, sim, error):
+        """Function that returns the resultant win pct estimate (or the error that stopped the simulation) in a popup window once
+            the worker thread finishes"""
+        self.worker.wait()
+        self.worker = None
+        self.button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.progress_label.setText("")
+
+        result = sim.result if sim is not None else None
+        if error:
+            text = "Simulation failed: " + error
+        elif result is None:
+            text = "Simulation cancelled"
+        elif result.cancelled:
+            text = "Estimated Win Probability: " + str(result) + " (cancelled after " + format(result.num_trials, ',') + " trials)"
+        else:
+            text = "Estimated Win Probability: " + str(result)
 
         msg = QMessageBox()
         icon = QIcon("app_icon.png")
         msg.setWindowIcon(icon)
         msg.setWindowTitle("Simulation Results")
-        msg.setText("Estimated Win Probability: " + result + "                      ")
+        msg.setText(text + "                      ")
 
         msg.exec_()
 
@@ -214,8 +295,18 @@ class App(QDialog):
 
         self.create_push_button()
 
+        self.cancel_button = QPushButton(self)
+        self.cancel_button.setText('Cancel')
+        self.cancel_button.setFixedHeight(30)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.pressed.connect(lambda: self.cancel_pressed())
+
+        self.progress_label = QLabel(self)
+
         layout = QGridLayout()
         layout.addWidget(self.button, 0, 0)
+        layout.addWidget(self.cancel_button, 0, 1)
+        layout.addWidget(self.progress_label, 1, 0, 1, 2)
 
         self.GroupBoxButton.setLayout(layout)
 
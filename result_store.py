@@ -0,0 +1,241 @@
+import simulation_engine as sim_engine
+import numpy as np
+import threading
+import hashlib
+import struct
+import math
+import os
+
+RESULT_STORE_DIR = 'result_store'
+INDEX_MAGIC = 0x3158444954535145 # b'EQSTIDX1'
+DATA_MAGIC = b'EQSTDAT1'
+INDEX_HEADER_SIZE = 4 # uint64s: magic, data file generation, number of slots, number of entries
+MIN_INDEX_SLOTS = 1024
+MAX_LOAD_FACTOR = 0.5 # the index doubles before more than half its slots are used
+RECORD_HEADER = struct.Struct('<QHHI') # key hash, mode code, totals size, key length
+MODES = ['exact', 'table', 'batch', 'adaptive', 'parallel', 'scalar'] # mode codes
+
+_stores = {} # directory -> ResultStore opened by this process (see get_store)
+_stores_lock = threading.Lock()
+
+
+class ResultStore:
+    """Class that keeps Simulation results on disk across processes: an append-only data file of (canonical scenario, mode, totals)
+        records and a memory mapped hash index (open addressing) from each scenario to its newest record.
+        Any number of processes can read while one at a time writes (an exclusive lock file, where the platform has fcntl).
+        A scenario's entry is only replaced by a more precise result (see get_precision); compact drops the replaced records."""
+
+    def __init__(self, path=RESULT_STORE_DIR):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.bin')
+        self.lock = threading.Lock() # data file reads and writes within this process
+        self.index = None # memory mapped uint64 index (header, then (key hash, data offset) slots)
+        self.index_inode = None
+        self.data_file = None
+
+        os.makedirs(path, exist_ok=True)
+        with self.write_lock():
+            if not os.path.exists(self.index_path):
+                self.write_index(0, [], MIN_INDEX_SLOTS)
+                with open(self.get_data_path(0), 'wb') as data_file:
+                    data_file.write(DATA_MAGIC)
+        self.refresh()
+
+    def __len__(self):
+        with self.lock:
+            self.refresh()
+            return int(self.index[3])
+
+    def close(self):
+        """Method that releases the index map and the data file"""
+        with self.lock:
+            self.index = None
+            if self.data_file is not None:
+                self.data_file.close()
+                self.data_file = None
+
+    def get_data_path(self, generation):
+        """Method that returns the path of a data file generation (compaction starts a new one)"""
+        return os.path.join(self.path, 'data.' + str(generation) + '.bin')
+
+    def write_lock(self):
+        """Method that returns a context manager holding the store's exclusive write lock (across processes)"""
+        return FileLock(os.path.join(self.path, 'lock'))
+
+    def refresh(self):
+        """Method that maps the current index (and opens its data file) if another writer has replaced it since the last call"""
+        inode = os.stat(self.index_path).st_ino
+        if self.index is not None and inode == self.index_inode:
+            return
+        self.index = np.memmap(self.index_path, dtype=np.uint64, mode='r+')
+        self.index_inode = inode
+        if self.data_file is not None:
+            self.data_file.close()
+        self.data_file = open(self.get_data_path(int(self.index[1])), 'rb')
+
+    def write_index(self, generation, entries, num_slots):
+        """Method that writes a new index for a data file generation with the (key hash, offset) entries and swaps it in atomically"""
+        index = np.zeros(INDEX_HEADER_SIZE + 2 * num_slots, dtype=np.uint64)
+        index[:INDEX_HEADER_SIZE] = [INDEX_MAGIC, generation, num_slots, len(entries)]
+        slots = index[INDEX_HEADER_SIZE:].reshape(num_slots, 2)
+        for key_hash, offset in entries:
+            slot = self.find_slot(slots, key_hash)
+            slots[slot] = key_hash, offset
+        temp_path = self.index_path + '.tmp'
+        index.tofile(temp_path)
+        os.replace(temp_path, self.index_path) # readers keep their old map until they refresh
+
+    def find_slot(self, slots, key_hash):
+        """Method that returns the slot holding key_hash, or the empty slot where it would go (linear probing)"""
+        slot = key_hash % len(slots)
+        while slots[slot, 0] != 0 and slots[slot, 0] != key_hash:
+            slot = (slot + 1) % len(slots)
+        return slot
+
+    def read_record(self, offset):
+        """Method that reads the data record at offset and returns (key, mode, totals), or None if it's from another TOTALS_SIZE"""
+        self.data_file.seek(offset)
+        key_hash, mode_code, totals_size, key_length = RECORD_HEADER.unpack(self.data_file.read(RECORD_HEADER.size))
+        totals = np.frombuffer(self.data_file.read(8 * totals_size), dtype='<i8').astype(np.int64)
+        key = self.data_file.read(key_length)
+        if totals_size != sim_engine.TOTALS_SIZE:
+            return None
+        return key, MODES[mode_code], totals
+
+    def get(self, scenario):
+        """Method that returns the stored (mode, totals array) of a Scenario (or its canonical form), or None"""
+        key = get_store_key(scenario)
+        key_hash = get_key_hash(key)
+        with self.lock:
+            self.refresh()
+            slots = self.index[INDEX_HEADER_SIZE:].reshape(-1, 2)
+            slot = self.find_slot(slots, key_hash)
+            offset = int(slots[slot, 1])
+            if offset == 0: # empty (or a slot whose offset a writer hasn't filled in yet)
+                return None
+            record = self.read_record(offset)
+        if record is None or record[0] != key: # (a 64 bit hash collision)
+            return None
+        return record[1], record[2]
+
+    def lookup(self, scenario, max_std_error=math.inf):
+        """Method that returns the stored (mode, totals array) of a Scenario if its win probability's standard error is at most
+            max_std_error (0 only accepts exact results), or None"""
+        stored = self.get(scenario)
+        if stored is None or (max_std_error == 0 and stored[0] != 'exact') or get_precision(*stored) > max_std_error:
+            return None
+        return stored
+
+    def put(self, scenario, mode, totals):
+        """Method that stores a result (a 1D totals array) for a Scenario if it's more precise than the stored one, and returns
+            whether it was stored"""
+        key = get_store_key(scenario)
+        key_hash = get_key_hash(key)
+        totals = np.asarray(totals, dtype='<i8')
+        with self.write_lock(), self.lock:
+            self.refresh()
+            slots = self.index[INDEX_HEADER_SIZE:].reshape(-1, 2)
+            slot = self.find_slot(slots, key_hash)
+            offset = int(slots[slot, 1])
+            if offset != 0:
+                record = self.read_record(offset)
+                if record is not None and record[0] == key and get_precision(record[1], record[2]) <= get_precision(mode, totals):
+                    return False
+
+            # append the record, then point the index at it (readers never see an offset before its record is written)
+            with open(self.get_data_path(int(self.index[1])), 'ab') as data_file:
+                new_offset = data_file.seek(0, os.SEEK_END)
+                data_file.write(RECORD_HEADER.pack(key_hash, MODES.index(mode), len(totals), len(key)) + totals.tobytes() + key)
+            if slots[slot, 0] == key_hash: # replaced
+                slots[slot, 1] = new_offset
+            elif int(self.index[3]) + 1 > MAX_LOAD_FACTOR * len(slots): # new, and the index is full: double it
+                entries = [(int(key_hash_), int(offset_)) for key_hash_, offset_ in slots if key_hash_ != 0] + [(key_hash, new_offset)]
+                self.write_index(int(self.index[1]), entries, 2 * len(slots))
+            else: # new
+                slots[slot, 0] = key_hash
+                slots[slot, 1] = new_offset
+                self.index[3] += 1
+            self.index.flush()
+            self.refresh()
+        return True
+
+    def compact(self):
+        """Method that rewrites the live records (one per scenario) to a new data file generation, drops the replaced ones and
+            returns the number of bytes reclaimed"""
+        with self.write_lock(), self.lock:
+            self.refresh()
+            generation = int(self.index[1])
+            old_path = self.get_data_path(generation)
+            slots = self.index[INDEX_HEADER_SIZE:].reshape(-1, 2)
+
+            entries = []
+            with open(self.get_data_path(generation + 1), 'wb') as data_file:
+                data_file.write(DATA_MAGIC)
+                for key_hash, offset in slots:
+                    if key_hash == 0 or offset == 0:
+                        continue
+                    # copy the record as is
+                    self.data_file.seek(int(offset))
+                    header = self.data_file.read(RECORD_HEADER.size)
+                    totals_size, key_length = RECORD_HEADER.unpack(header)[2:]
+                    entries.append((int(key_hash), data_file.tell()))
+                    data_file.write(header + self.data_file.read(8 * totals_size + key_length))
+                new_size = data_file.tell()
+
+            old_size = os.path.getsize(old_path)
+            num_slots = MIN_INDEX_SLOTS
+            while len(entries) > MAX_LOAD_FACTOR * num_slots:
+                num_slots *= 2
+            self.write_index(generation + 1, entries, num_slots)
+            self.refresh()
+            os.remove(old_path) # readers that still have it open keep reading it until they refresh
+        return old_size - new_size
+
+
+class FileLock:
+    """Class that holds an exclusive lock on a file while in a with block (fcntl; no locking where fcntl isn't available)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        try:
+            import fcntl
+        except ImportError: # Windows: single writer process assumed
+            return self
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close() # (releases the lock)
+        self.file = None
+
+def get_store_key(scenario):
+    """Function that returns the bytes a Scenario (or its canonical form, see simulation_engine.get_canonical_scenario) is stored under"""
+    if isinstance(scenario, sim_engine.Scenario):
+        scenario = sim_engine.get_canonical_scenario(scenario)
+    return repr(scenario).encode()
+
+def get_key_hash(key):
+    """Function that returns the non zero 64 bit index hash of a store key (0 marks an empty slot)"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
+
+def get_precision(mode, totals):
+    """Function that returns the standard error of a stored result's win probability (0 only for exact results); lower is more precise.
+        Sampled results are floored at the standard error of the smoothed win rate (wins + 0.5) / (rounds + 1), so one that
+        never (or always) won isn't taken for exact."""
+    if mode == 'exact':
+        return 0.0
+    count, wins = int(totals[0]), int(totals[1])
+    smoothed = (wins + 0.5) / (count + 1)
+    return max(sim_engine.get_std_errors(totals)[0], math.sqrt(smoothed * (1 - smoothed) / count))
+
+def get_store(path=RESULT_STORE_DIR):
+    """Function that returns the process wide ResultStore of a directory (opened on first use, e.g. in a pool worker)"""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = ResultStore(path)
+        return store
@@ -1,89 +1,910 @@
 import holdem_engine as hldm
-from functools import reduce
+import hash_tools
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import numpy as np
 import itertools
+import threading
 import random
-import pickle
+import math
+import time
+import os
+
+EXACT_MAX_OUTCOMES = 1100*1000 # mode 'auto' enumerates spots with up to this many deals (e.g. heads up from the flop on, 2 opponents on the river)
+EXACT_HARD_MAX_OUTCOMES = 50*1000*1000 # mode 'exact' refuses spots with more deals (every deal is held in memory, ~10 bytes each)
+MIN_ADAPTIVE_ROUNDS = 2000 # mode 'adaptive' never stops on its error target before this many rounds (early estimates are unreliable)
+MAX_ADAPTIVE_ROUNDS = 1000*1000
+CONFIDENCE_Z = 1.96 # normal quantile for 95% confidence intervals
+PARALLEL_CHUNK_ROUNDS = 5000 # rounds per parallel task; chunks (not workers) get their own seeds so results don't depend on core count
+MAX_RANGE_REDRAWS = 1000 # deals where hand ranges share a card are redrawn at most this many times
+POT_SHARE_UNITS = 2520 # lcm(1..10): a 1/k share of a split pot is a whole number of units for up to 10 players
+EVALUATION_RATE = 5*1000*1000 # hands evaluate_batch scores per second on one core (roughly), to size runout tables to a time budget
+RUNOUT_CACHE_SIZE = 16 # board runout tables kept by runout_cache (a flop's table is ~3.5 MB, a turn's ~140 KB)
+SAMPLING_SCHEMES = ('random', 'stratified', 'antithetic') # how the simulated modes deal (see Simulation.run)
+
+# every mode returns a totals array: rounds, wins, ties (split pots), pot share units, squared pot share units (for the equity
+# standard error), the number of rounds the user's final hand was of each hand type (hash_tools.HAND_TYPES), then for
+# variance reduced sampling the number of replicates and their squared wins and squared pot share units (see get_std_errors)
+NUM_HAND_TYPES = len(hash_tools.HAND_TYPES)
+REPLICATE_TOTALS = 5 + NUM_HAND_TYPES # index of the replicate totals
+TOTALS_SIZE = REPLICATE_TOTALS + 3
+RANK_HAND_TYPES = hash_tools.get_rank_hand_types() # universal rank -> hand type index
+
+SUIT_PERMUTATIONS = list(itertools.permutations(range(4)))
+
+# every 2 card holding as Card ids, and a (53, 53) matrix mapping a pair of Card ids (either order) to its holding index
+HOLDING_IDS = np.array(list(itertools.combinations(range(1, 53), 2)), dtype=np.int64)
+HOLDING_INDEX = np.full((53, 53), -1, dtype=np.int64)
+HOLDING_INDEX[HOLDING_IDS[:, 0], HOLDING_IDS[:, 1]] = HOLDING_INDEX[HOLDING_IDS[:, 1], HOLDING_IDS[:, 0]] = np.arange(len(HOLDING_IDS))
+
+_evaluator = None # process wide eval tables shared by every Simulation (see get_evaluator)
+_evaluator_lock = threading.Lock()
+_metrics_callbacks = [] # called with the Metrics of every instrumented run (see add_metrics_callback)
 
 
 class Simulation:
     """Class that represents a Poker simulation"""
-    def __init__(self, scenario):
+    def __init__(self, scenario, evaluator=None):
         self.scenario = scenario # object of type Scenario
         self.result = None # object of type Results
-        with open('hash_lookup.pickle', 'rb') as handle:
-            self.lookup_score = pickle.load(handle) # eval hash table (type dict)
+        start_time = time.perf_counter()
+        if evaluator is None:
+            evaluator = get_evaluator()
+        self.evaluator = evaluator # 7 card eval tables (hash_tools.py)
+        self.load_time = time.perf_counter() - start_time # eval table load time (~0 once the process has loaded them)
+        self.stop_event = threading.Event() # set by cancel
+        self.metrics = None # Metrics of the running (or last) instrumented run
+
+    def cancel(self):
+        """Method that asks a running (or about to run) simulation, e.g. on another thread, to stop after its current batch.
+            run then reports the rounds simulated so far (Results.cancelled), or no result if there are none or if the run was
+            an exact enumeration."""
+        self.stop_event.set()
+
+    def run(self, mode='auto', seed=None, num_rounds=15*1000, executor=None, target_std_error=None, ci_width=None, time_budget=None,
+            use_cache=True, progress=None, all_seats=False, sampling='random', instrument=False, store=None):
+        """Method that runs simulations and returns (and stores in self.result) the user's Results.
+            mode 'batch' scores thousands of deals at once with NumPy, mode 'parallel' splits the batches across a process pool
+            (executor, see create_pool), mode 'exact' enumerates every deal and mode 'scalar' is the reference (one deal at a time) loop.
+            mode 'adaptive' runs batches until the win probability's standard error reaches target_std_error (or the 95% confidence
+            interval is ci_width wide) or time_budget seconds have passed.
+            mode 'table' answers preflop scenarios from the precomputed preflop table (equity_tables.py).  Heads-up flop scenarios
+            against a random opponent are answered with exact totals (mode 'exact') from the flop table in modes 'auto', 'table' and 'exact'.
+            mode 'auto' picks 'table' when the preflop table covers the scenario (at the requested precision), else 'exact' when there are
+            at most EXACT_MAX_OUTCOMES deals, else 'adaptive' if a target or time budget is given and 'batch' otherwise.
+            Players without known hole cards but with a Range (see Player.assign_range) are dealt from it; such scenarios are only
+            simulated (never 'table' or 'exact').
+            With use_cache, repeated and suit isomorphic scenarios are answered from result_cache.
+            progress(count, wins, ties) is called with the user's running totals after every batch of the 'batch' and 'adaptive' modes.
+            Opponents with known hole cards keep them.  With all_seats, every seat's Results (user first, then the opponents) are
+            computed from the same deals and stored in self.seat_results, e.g. for the equity of several known hands at showdown.
+            sampling (modes 'batch', 'adaptive' and 'parallel') picks how deals are drawn: 'random' deals independently,
+            'stratified' deals every possible next board card equally often and 'antithetic' pairs each deal with one drawn from the
+            reversed shuffle.  Both reduce the variance of the estimates; their standard errors come from independent replicates
+            (one deal per next board card, or one pair), and num_rounds is rounded up to whole replicates.
+            With instrument (or any callback added with add_metrics_callback) the run's Metrics (time per phase, counters,
+            trials per second and cache hit rates) are attached to the Results and passed to the callbacks.
+            With a store (result_store.ResultStore), unseeded user results are looked up on disk first (accepted if at least as
+            precise as requested, see get_required_std_error) and new results are saved to it."""
+        start_time = time.perf_counter()
+        metrics = self.metrics = Metrics() if instrument or _metrics_callbacks else None
+        if metrics is not None:
+            metrics.add_time('load', self.load_time)
+            self.load_time = 0.0 # counted once
+        if target_std_error is None and ci_width is not None:
+            target_std_error = ci_width / (2 * CONFIDENCE_Z)
+
+        cached = cache_key = None
+        if use_cache:
+            # (the evaluator too: results from other eval tables, see set_evaluator, aren't interchangeable)
+            cache_key = (self.evaluator, get_canonical_scenario(self.scenario), mode, seed, num_rounds, target_std_error, time_budget, all_seats, sampling)
+            cached = result_cache.get(cache_key)
+            if metrics is not None:
+                metrics.add_time('cache', time.perf_counter() - start_time)
+                metrics.count('result_cache_hits' if cached is not None else 'result_cache_misses')
+
+        use_store = store is not None and seed is None and not all_seats and mode not in ('scalar', 'table')
+        if cached is None and use_store:
+            stored = store.lookup(self.scenario, get_required_std_error(mode, num_rounds, target_std_error, time_budget))
+            if metrics is not None:
+                metrics.count('result_store_hits' if stored is not None else 'result_store_misses')
+            if stored is not None:
+                cached = (stored[0], stored[1][np.newaxis])
+                if use_cache:
+                    result_cache.put(cache_key, cached)
+
+        if cached is not None:
+            mode, totals = cached
+        else:
+            num_seats = 1 + len(self.scenario.opponents) if all_seats else 1
+            mode, totals = self.simulate(mode, seed, num_rounds, executor, target_std_error, time_budget, progress, num_seats, sampling)
+            if use_cache and not self.stop_event.is_set(): # partial (cancelled) results aren't cached
+                result_cache.put(cache_key, (mode, totals))
+            if use_store and mode != 'table' and not self.stop_event.is_set():
+                store.put(self.scenario, mode, totals[0])
+
+        cancelled = cached is None and self.stop_event.is_set()
+        self.stop_event.clear() # ready to run again
+        self.result = None
+        self.seat_results = []
+        elapsed = time.perf_counter() - start_time
+        if metrics is not None:
+            metrics.finish(mode, int(totals[0, 0]), elapsed)
+        if totals[0, 0] > 0: # (no rounds if cancelled before any results)
+            self.seat_results = [Results(seat_totals, mode, elapsed, cancelled, metrics) for seat_totals in totals]
+            self.result = self.seat_results[0]
+        if metrics is not None:
+            for callback in list(_metrics_callbacks):
+                callback(metrics)
+        return self.result
+
+    def simulate(self, mode, seed, num_rounds, executor, target_std_error, time_budget, progress=None, num_seats=1, sampling='random'):
+        """Method that resolves mode 'auto', runs the simulation (see run) and returns the mode used and the totals arrays
+            (see TOTALS_SIZE) of the first num_seats seats as a (num_seats, TOTALS_SIZE) array"""
+        if sampling not in SAMPLING_SCHEMES:
+            raise ValueError("Unknown sampling scheme: " + str(sampling))
+        if sampling != 'random' and mode == 'scalar':
+            raise ValueError("Mode 'scalar' only supports random sampling")
+
+        preflop = flop = None
+        if mode in ('auto', 'table', 'exact') and num_seats == 1: # the tables only hold the user's totals
+            flop = self.lookup_flop()
+            if mode != 'exact' and flop is None:
+                max_std_error = math.inf if mode == 'table' else get_required_std_error(mode, num_rounds, target_std_error, time_budget)
+                preflop = self.lookup_preflop(max_std_error)
+            if mode == 'table' and preflop is None and flop is None:
+                raise ValueError("No equity table covers this scenario")
+
+        if mode == 'exact' and self.has_ranges():
+            raise ValueError("Exact enumeration doesn't support hand ranges")
+
+        if flop is not None: # exact totals, so reported as mode 'exact'
+            if self.metrics is not None:
+                self.metrics.count('table_lookups')
+            return 'exact', flop[np.newaxis]
+
+        if mode == 'auto':
+            if preflop is not None:
+                mode = 'table'
+            elif not self.has_ranges() and self.count_outcomes() <= EXACT_MAX_OUTCOMES:
+                mode = 'exact'
+            elif target_std_error is not None or time_budget is not None:
+                mode = 'adaptive'
+            else:
+                mode = 'batch'
 
-    def run(self):
-        """Method that runs simulations and returns estimated win probability"""
-        count = total_wins = total_ties = 0
-        num_rounds = 15*1000
+        if mode == 'table':
+            totals = preflop[np.newaxis]
+            if self.metrics is not None:
+                self.metrics.count('table_lookups')
+        elif mode == 'exact':
+            totals = self.run_exact(num_seats=num_seats)
+        elif mode == 'adaptive':
+            totals = self.run_adaptive(target_std_error, time_budget, seed=seed, progress=progress, num_seats=num_seats, sampling=sampling)
+        elif mode == 'batch':
+            totals = self.run_batch(num_rounds, seed, progress=progress, num_seats=num_seats, sampling=sampling)
+        elif mode == 'parallel':
+            totals = self.run_parallel(num_rounds, seed, executor, num_seats, sampling)
+        elif mode == 'scalar':
+            totals = self.run_scalar(num_rounds, seed, num_seats)
+        else:
+            raise ValueError("Unknown simulation mode: " + str(mode))
 
+        return mode, totals
+
+    def lookup_preflop(self, max_std_error=math.inf):
+        """Method that returns the precomputed totals array for a preflop scenario (equity_tables.py), or None if
+            there is no preflop table, it doesn't cover the scenario or its standard error is above max_std_error"""
+        import equity_tables # (imported here: equity_tables builds its tables with this module)
+        preflop_table = equity_tables.get_preflop_table()
+        if preflop_table is None:
+            return None
+
+        preflop = preflop_table.lookup(self.scenario)
+        if preflop is not None and get_std_error(preflop[1], preflop[0]) > max_std_error:
+            return None
+        return preflop
+
+    def lookup_flop(self):
+        """Method that returns the exact totals array for a heads-up flop scenario from the flop table (equity_tables.py), or None if
+            there is no flop table or it doesn't cover the scenario"""
+        import equity_tables
+        flop_table = equity_tables.get_flop_table()
+        if flop_table is None:
+            return None
+        return flop_table.lookup(self.scenario)
+
+    def get_deal_setup(self):
+        """Method that returns the known user/board Card ids, the ids still available in the deck, the number of cards to deal
+            to the user and the board, and a list of each opponent's known hole Card ids (empty for a random opponent)"""
         deck = hldm.Deck()
-        prime_map = dict()
-        for card in deck.cards:
-            prime_map[card.prime_id] = card
 
-        user = self.scenario.user
-        user_cards = user.hole_cards
-        board_cards = self.scenario.board_cards
+        user_ids = [card.id for card in self.scenario.user.hole_cards]
+        board_ids = [card.id for card in self.scenario.board_cards]
+        opp_ids = [[card.id for card in opponent.hole_cards] for opponent in self.scenario.opponents]
+
+        num_missing_user = 2 - len(user_ids)
+        num_missing_board = 5 - len(board_ids)
+
+        burnt_ids = user_ids + board_ids + [card_id for ids in opp_ids for card_id in ids]
+        avbl_ids = [card.id for card in deck.cards if card.id not in burnt_ids]
+
+        return user_ids, board_ids, avbl_ids, num_missing_user, num_missing_board, opp_ids
+
+    def get_seat_columns(self, num_missing_user, num_missing_board, opp_ids):
+        """Method that returns, for every seat (user first), the columns of its 2 hole cards in a deal (missing user cards,
+            missing board cards, then each opponent's missing cards) extended with the known Card ids (user, board, then
+            each opponent's known cards) as a (1 + num_opponents, 2) list, and the board's 5 columns"""
+        num_ids = num_missing_user + num_missing_board + sum(2 - len(ids) for ids in opp_ids)
+        user_columns = [num_ids + i for i in range(2 - num_missing_user)] + list(range(num_missing_user))
+        known_column = num_ids + 2 - num_missing_user
+        board_columns = [known_column + i for i in range(5 - num_missing_board)]
+        board_columns += list(range(num_missing_user, num_missing_user + num_missing_board))
+        known_column += 5 - num_missing_board
+
+        seat_columns = [user_columns]
+        column = num_missing_user + num_missing_board
+        for ids in opp_ids:
+            num_missing = 2 - len(ids)
+            seat_columns.append(list(range(known_column, known_column + len(ids))) + list(range(column, column + num_missing)))
+            known_column += len(ids)
+            column += num_missing
+        return seat_columns, board_columns
+
+    def has_ranges(self):
+        """Method that returns True if any player is dealt from a hand Range"""
+        return any(get_dealt_range(player) is not None for player in [self.scenario.user] + self.scenario.opponents)
+
+    def get_range_columns(self, num_missing_user, num_missing_board):
+        """Method that returns a (column, Range) pair for each player dealt from a hand Range, column being where their 2 cards go
+            in a deal (missing user cards, missing board cards, then each opponent's missing cards)"""
+        range_columns = []
+        if get_dealt_range(self.scenario.user) is not None:
+            range_columns.append((0, self.scenario.user.range))
+        column = num_missing_user + num_missing_board
+        for opponent in self.scenario.opponents:
+            if get_dealt_range(opponent) is not None:
+                range_columns.append((column, opponent.range))
+            column += 2 - len(opponent.hole_cards)
+        return range_columns
+
+    def deal_range_combos(self, rndm, range_columns, dead_ids):
+        """Method that draws one combo per (column, Range) pair with a random.Random, redrawing when two combos share a card,
+            and returns their Card ids as a flat list"""
+        for _ in range(MAX_RANGE_REDRAWS):
+            range_ids = [card_id for column, player_range in range_columns for card_id in player_range.sample_one(rndm, dead_ids)]
+            if len(set(range_ids)) == len(range_ids):
+                return range_ids
+        raise ValueError("The hand ranges can't be dealt together")
+
+    def get_replicate_size(self, sampling, num_missing_board, num_avbl, range_columns=()):
+        """Method that returns the number of deals in one replicate of a sampling scheme (see run), 0 for 'random' sampling"""
+        if sampling == 'antithetic':
+            return 2
+        if sampling == 'stratified':
+            # the next board card is only uniform over the available cards when no hand range takes cards first
+            if num_missing_board == 0 or range_columns:
+                raise ValueError("Stratified sampling needs a missing board card and no hand ranges")
+            return num_avbl
+        return 0
+
+    def deal_batch(self, rng, size, avbl_ids, num_ids, range_columns=(), dead_ids=(), sampling='random', board_column=0):
+        """Method that deals size random deals with a NumPy Generator and returns them as a (size, num_ids) array of Card ids.
+            Players in range_columns (see get_range_columns) get a combo from their Range, the other cards are uniformly random.
+            With 'antithetic' sampling consecutive deals come from a shuffle and its reverse; with 'stratified' sampling the
+            card at board_column (the next board card) cycles through avbl_ids.  size must be a whole number of replicates."""
+        if sampling == 'antithetic':
+            # 1 - u is as uniform as u, and sorts the available cards in the reverse order
+            keys = rng.random((size // 2, 1, len(avbl_ids)))
+            keys = np.concatenate([keys, 1 - keys], axis=1).reshape(size, len(avbl_ids))
+        else:
+            keys = rng.random((size, len(avbl_ids)))
+
+        if sampling == 'stratified':
+            # each row's stratum card sorts last, the other cards are dealt from what's left
+            strata = np.arange(size) % len(avbl_ids)
+            keys[np.arange(size), strata] = 2.0
+            rndm_ids = np.empty((size, num_ids), dtype=np.int64)
+            rndm_ids[:, board_column] = avbl_ids[strata]
+            other_cols = [column for column in range(num_ids) if column != board_column]
+            rndm_ids[:, other_cols] = avbl_ids[np.argsort(keys, axis=1)[:, :num_ids - 1]]
+            return rndm_ids
 
-        user_primes = [card.prime_id for card in user_cards]
-        board_primes = [card.prime_id for card in board_cards]
+        if not range_columns:
+            # every row is an independent deal: sorting random keys gives a random order of the available cards
+            return avbl_ids[np.argsort(keys, axis=1)[:, :num_ids]]
 
-        length_board = len(board_cards)
-        length_hole = len(user_cards)
-        num_missing_board = 5 - length_board
-        num_missing_user = 2 - length_hole
+        # alias table draws for every ranged player; deals where two combos share a card are redrawn
+        range_ids = np.hstack([player_range.sample(rng, size, dead_ids) for column, player_range in range_columns])
+        for _ in range(MAX_RANGE_REDRAWS):
+            sorted_ids = np.sort(range_ids, axis=1)
+            clashes = np.nonzero((sorted_ids[:, 1:] == sorted_ids[:, :-1]).any(axis=1))[0]
+            if len(clashes) == 0:
+                break
+            range_ids[clashes] = np.hstack([player_range.sample(rng, len(clashes), dead_ids) for column, player_range in range_columns])
+        else:
+            raise ValueError("The hand ranges can't be dealt together")
 
-        burnt_primes = user_primes + board_primes
-        avbl_primes = [card.prime_id for card in deck.cards if card.prime_id not in burnt_primes]
+        # the combo cards sort last so the other cards are dealt from what's left
+        positions = np.zeros(53, dtype=np.int64)
+        positions[avbl_ids] = np.arange(len(avbl_ids))
+        keys[np.arange(size)[:, np.newaxis], positions[range_ids]] = 2.0
 
-        opponents = self.scenario.opponents
-        num_opponents = len(opponents)
-        num_primes = num_missing_user + num_missing_board + (num_opponents * 2)
+        range_cols = [column + i for column, player_range in range_columns for i in (0, 1)]
+        other_cols = [column for column in range(num_ids) if column not in range_cols]
+        rndm_ids = np.empty((size, num_ids), dtype=np.int64)
+        rndm_ids[:, range_cols] = range_ids
+        rndm_ids[:, other_cols] = avbl_ids[np.argsort(keys, axis=1)[:, :len(other_cols)]]
+        return rndm_ids
+
+    def run_scalar(self, num_rounds, seed=None, num_seats=1):
+        """Method that simulates num_rounds deals one at a time and returns the totals arrays of the first num_seats seats
+            (reference implementation)"""
+        count = 0
+        totals = [[0] * TOTALS_SIZE for _ in range(num_seats)]
+        rank_hand_types = RANK_HAND_TYPES.tolist()
+        rndm = random.Random(seed)
+
+        user_ids, board_ids, avbl_ids, num_missing_user, num_missing_board, opp_ids = self.get_deal_setup()
+        num_ids = num_missing_user + num_missing_board + sum(2 - len(ids) for ids in opp_ids)
+        range_columns = self.get_range_columns(num_missing_user, num_missing_board)
+        num_uniform = num_ids - 2 * len(range_columns)
+        dead_ids = user_ids + board_ids + [card_id for ids in opp_ids for card_id in ids]
+        known_ids = dead_ids # appended to every deal (see get_seat_columns)
+        seat_columns, board_columns = self.get_seat_columns(num_missing_user, num_missing_board, opp_ids)
+        deck = hldm.Deck() # one deck, with the known cards removed, reused for every deal
+        for card_id in dead_ids:
+            deck.remove_card(hldm.int_to_card(card_id))
+        start_time = time.perf_counter()
         for _ in range(num_rounds):
             count += 1
 
-            rndm_primes = random.sample(avbl_primes, num_primes)
-            user_primes_full = user_primes + rndm_primes[:num_missing_user]
-            board_primes_full = board_primes + rndm_primes[num_missing_user:num_missing_board]
-            user_score = self.get_score(user_primes_full, board_primes_full)
-
-            num_beaten = 0
-            num_tied = 0
-            start_index = num_missing_board + num_missing_user
-            for __ in range(num_opponents):
-                end_index = start_index + 2
-                opp_primes = rndm_primes[start_index:end_index]
-                start_index += 2
-                opp_score = self.get_score(board_primes_full, opp_primes)
-                if opp_score < user_score:
-                    pass
-                elif opp_score == user_score:
-                    num_tied += 1
-                else:
-                    num_beaten += 1
+            if range_columns: # combos from the ranges first, then the other cards from what's left
+                range_ids = self.deal_range_combos(rndm, range_columns, dead_ids)
+                deck.reset(keep_removed=False)
+                for card_id in dead_ids + range_ids:
+                    deck.remove_card(hldm.int_to_card(card_id))
+            else:
+                deck.reset()
+            deck.shuffle(num_uniform, rndm)
+            rndm_ids = deck.draw_ids(num_uniform)
+            for i, (column, player_range) in enumerate(range_columns):
+                rndm_ids[column:column] = range_ids[2 * i:2 * i + 2]
+            deal_ids = rndm_ids + known_ids
+            board_ids_full = [deal_ids[column] for column in board_columns]
+            scores = [self.get_score(board_ids_full, [deal_ids[column] for column in columns]) for columns in seat_columns]
+
+            best_score = min(scores)
+            num_best = scores.count(best_score)
+            share = POT_SHARE_UNITS // num_best
+            for seat_totals, score in zip(totals, scores):
+                seat_totals[0] += 1
+                if score == best_score:
+                    if num_best == 1:
+                        seat_totals[1] += 1
+                    else: # split pot
+                        seat_totals[2] += 1
+                    seat_totals[3] += share
+                    seat_totals[4] += share * share
+                seat_totals[5 + rank_hand_types[score]] += 1
+
+            if count % 1000 == 0 and self.stop_event.is_set():
+                break
+
+        if self.metrics is not None: # (per phase timing would slow the one deal at a time loop down)
+            self.metrics.add_time('scalar loop', time.perf_counter() - start_time)
+            self.metrics.count('evaluations', count * len(seat_columns))
+        return np.array(totals, dtype=np.int64)
+
+    def run_batch(self, num_rounds, seed=None, batch_size=5000, progress=None, num_seats=1, sampling='random'):
+        """Method that simulates num_rounds deals in NumPy batches and returns the totals arrays of the first num_seats seats.
+            progress(count, wins, ties) is called with the user's totals after every batch; the loop stops early if the
+            simulation is cancelled.  Variance reduced sampling (see run) deals whole replicates, rounding num_rounds up."""
+        count = 0
+        totals = np.zeros((num_seats, TOTALS_SIZE), dtype=np.int64)
+        metrics = self.metrics
+        start_time = time.perf_counter()
+        rng = np.random.default_rng(seed)
+
+        user_ids, board_ids, avbl_ids, num_missing_user, num_missing_board, opp_ids = self.get_deal_setup()
+        num_ids = num_missing_user + num_missing_board + sum(2 - len(ids) for ids in opp_ids)
+        range_columns = self.get_range_columns(num_missing_user, num_missing_board)
+        dead_ids = user_ids + board_ids + [card_id for ids in opp_ids for card_id in ids]
+        avbl_ids = np.array(avbl_ids, dtype=np.int64)
+        replicate_size = self.get_replicate_size(sampling, num_missing_board, len(avbl_ids), range_columns)
+        if replicate_size:
+            num_rounds = -(-num_rounds // replicate_size) * replicate_size
+            batch_size = max(1, batch_size // replicate_size) * replicate_size
+        if metrics is not None:
+            metrics.add_time('setup', time.perf_counter() - start_time)
+        runout = self.get_runout_table(num_rounds * (1 + len(opp_ids)))
+        while count < num_rounds:
+            size = min(batch_size, num_rounds - count)
+            count += size
+
+            start_time = time.perf_counter()
+            rndm_ids = self.deal_batch(rng, size, avbl_ids, num_ids, range_columns, dead_ids, sampling, num_missing_user)
+            dealt_time = time.perf_counter()
+            scores = self.get_batch_scores(rndm_ids, user_ids, board_ids, num_missing_user, num_missing_board, opp_ids, runout)
+            scored_time = time.perf_counter()
+            totals += self.get_totals(scores, num_seats, replicate_size)
+            if metrics is not None:
+                metrics.add_time('sampling', dealt_time - start_time)
+                metrics.add_time('scoring', scored_time - dealt_time)
+                metrics.add_time('totals', time.perf_counter() - scored_time)
+                metrics.count('batches')
+
+            if progress is not None:
+                progress(int(totals[0, 0]), int(totals[0, 1]), int(totals[0, 2]))
+            if self.stop_event.is_set():
+                break
+
+        return totals
+
+    def get_totals(self, scores, num_seats=1, replicate_size=0):
+        """Method that takes in an (n, 1 + num_opponents) array of hand scores (user first, see get_batch_scores) and returns
+            the totals arrays of those n rounds for the first num_seats seats as a (num_seats, TOTALS_SIZE) array.
+            Every seat is scored against the same rank vector: the lowest scores of a round share its pot.
+            With a replicate_size, every replicate_size consecutive rounds are one replicate (see get_std_errors)."""
+        best = scores == scores.min(axis=1, keepdims=True)
+        num_best = np.count_nonzero(best, axis=1)[:, np.newaxis]
+        best = best[:, :num_seats]
+        shares = np.where(best, POT_SHARE_UNITS // num_best, 0)
+
+        # hand types of every seat counted in one bincount, offset by seat
+        hand_types = RANK_HAND_TYPES[scores[:, :num_seats]] + np.arange(num_seats) * NUM_HAND_TYPES
+
+        totals = np.empty((num_seats, TOTALS_SIZE), dtype=np.int64)
+        totals[:, 0] = len(scores)
+        totals[:, 1] = np.count_nonzero(best & (num_best == 1), axis=0)
+        totals[:, 2] = np.count_nonzero(best & (num_best > 1), axis=0)
+        totals[:, 3] = shares.sum(axis=0)
+        totals[:, 4] = (shares * shares).sum(axis=0)
+        totals[:, 5:REPLICATE_TOTALS] = np.bincount(hand_types.ravel(), minlength=num_seats * NUM_HAND_TYPES).reshape(num_seats, NUM_HAND_TYPES)
+
+        totals[:, REPLICATE_TOTALS:] = 0
+        if replicate_size:
+            replicate_wins = (best & (num_best == 1)).reshape(-1, replicate_size, num_seats).sum(axis=1)
+            replicate_shares = shares.reshape(-1, replicate_size, num_seats).sum(axis=1)
+            totals[:, REPLICATE_TOTALS] = len(replicate_wins)
+            totals[:, REPLICATE_TOTALS + 1] = (replicate_wins * replicate_wins).sum(axis=0)
+            totals[:, REPLICATE_TOTALS + 2] = (replicate_shares * replicate_shares).sum(axis=0)
+        return totals
+
+    def get_batch_scores(self, rndm_ids, user_ids, board_ids, num_missing_user, num_missing_board, opp_ids, runout=None):
+        """Method that takes in an (n, num_ids) array of dealt Card ids (missing user cards, missing board cards, then each
+            opponent's missing cards) and returns an (n, 1 + num_opponents) array of hand scores; the user is column 0.
+            With a runout table of the known board (see get_runout_table) the scores are looked up instead of evaluated."""
+        size = len(rndm_ids)
+        known_ids = np.array(user_ids + board_ids + [card_id for ids in opp_ids for card_id in ids], dtype=np.int64)
+        deal_ids = np.hstack([rndm_ids, np.broadcast_to(known_ids, (size, len(known_ids)))])
+        seat_columns, board_columns = self.get_seat_columns(num_missing_user, num_missing_board, opp_ids)
+
+        if runout is not None:
+            # runout row of the dealt board cards (see build_runout_table), then one holding index per seat
+            runout_columns = deal_ids[:, num_missing_user:num_missing_user + num_missing_board]
+            if num_missing_board == 2:
+                rows = HOLDING_INDEX[runout_columns[:, 0], runout_columns[:, 1]]
+            elif num_missing_board == 1:
+                rows = runout_columns[:, 0]
+            else:
+                rows = np.zeros(size, dtype=np.int64)
+            hole_ids = deal_ids[:, np.array(seat_columns, dtype=np.int64)]
+            if self.metrics is not None:
+                self.metrics.count('runout_lookups', size * len(seat_columns))
+            return runout[rows[:, np.newaxis], HOLDING_INDEX[hole_ids[:, :, 0], hole_ids[:, :, 1]]]
+
+        # (size, 1 + num_opponents, 7) matrix of every player's 7 cards (board + hole cards)
+        columns = np.array([board_columns + hole_columns for hole_columns in seat_columns], dtype=np.int64)
+        player_ids = deal_ids[:, columns]
+        if self.metrics is not None:
+            self.metrics.count('evaluations', size * len(seat_columns))
+        return self.evaluator.evaluate_batch(player_ids.reshape(-1, 7)).reshape(size, len(seat_columns))
+
+    def count_outcomes(self):
+        """Method that returns the number of distinct deals (missing user cards, missing board cards and every opponent's
+            missing hole cards)"""
+        user_ids, board_ids, avbl_ids, num_missing_user, num_missing_board, opp_ids = self.get_deal_setup()
+        num_avbl = len(avbl_ids)
+        num_outcomes = 1
+        for num_cards in [num_missing_user, num_missing_board] + [2 - len(ids) for ids in opp_ids]:
+            num_outcomes *= math.comb(num_avbl, num_cards)
+            num_avbl -= num_cards
+        return num_outcomes
+
+    def run_exact(self, batch_size=100000, num_seats=1):
+        """Method that enumerates every distinct deal and returns the totals arrays of the first num_seats seats (exact, no sampling error).
+            Raises ValueError if there are more than EXACT_HARD_MAX_OUTCOMES deals."""
+        num_outcomes = self.count_outcomes()
+        if num_outcomes > EXACT_HARD_MAX_OUTCOMES:
+            raise ValueError("Too many deals to enumerate (" + str(num_outcomes) + ", at most " + str(EXACT_HARD_MAX_OUTCOMES) + "); use a simulated mode")
+        metrics = self.metrics
+        start_time = time.perf_counter()
+        user_ids, board_ids, avbl_ids, num_missing_user, num_missing_board, opp_ids = self.get_deal_setup()
+        avbl_ids = np.array(avbl_ids, dtype=np.int64)
+
+        # build every deal one stage (user, board, each opponent) at a time as rows of positions in avbl_ids
+        deals = np.zeros((1, 0), dtype=np.int8)
+        for num_cards in [num_missing_user, num_missing_board] + [2 - len(ids) for ids in opp_ids]:
+            num_left = len(avbl_ids) - deals.shape[1]
+            combos = np.array(list(itertools.combinations(range(num_left), num_cards)), dtype=np.int8)
+            combos = combos.reshape(math.comb(num_left, num_cards), num_cards)
+
+            # positions each deal has left, in order, then every combination of them appended to every deal
+            left = np.ones((len(deals), len(avbl_ids)), dtype=bool)
+            np.put_along_axis(left, deals.astype(np.int64), False, axis=1)
+            left = np.nonzero(left)[1].astype(np.int8).reshape(len(deals), num_left)
+            deals = np.hstack([np.repeat(deals, len(combos), axis=0), left[:, combos].reshape(len(deals) * len(combos), num_cards)])
+
+        totals = np.zeros((num_seats, TOTALS_SIZE), dtype=np.int64)
+        if metrics is not None:
+            metrics.add_time('enumeration', time.perf_counter() - start_time)
+        runout = self.get_runout_table(len(deals) * (1 + len(opp_ids)))
+        for start in range(0, len(deals), batch_size):
+            start_time = time.perf_counter()
+            rndm_ids = avbl_ids[deals[start:start + batch_size]]
+            scores = self.get_batch_scores(rndm_ids, user_ids, board_ids, num_missing_user, num_missing_board, opp_ids, runout)
+            scored_time = time.perf_counter()
+            totals += self.get_totals(scores, num_seats)
+            if metrics is not None:
+                metrics.add_time('scoring', scored_time - start_time)
+                metrics.add_time('totals', time.perf_counter() - scored_time)
+                metrics.count('batches')
+
+            if self.stop_event.is_set(): # a partial enumeration isn't a random sample, so it's discarded
+                return np.zeros((num_seats, TOTALS_SIZE), dtype=np.int64)
+
+        return totals
+
+    def run_adaptive(self, target_std_error=None, time_budget=None, max_rounds=MAX_ADAPTIVE_ROUNDS, seed=None, chunk_size=2500, progress=None,
+                     num_seats=1, sampling='random'):
+        """Method that simulates chunk_size rounds at a time until the user's win probability's standard error is at most target_std_error,
+            time_budget seconds have passed, max_rounds have been run or the simulation is cancelled, and returns the totals arrays
+            of the first num_seats seats.  progress(count, wins, ties) is called after every chunk."""
+        totals = np.zeros((num_seats, TOTALS_SIZE), dtype=np.int64)
+        rng = np.random.default_rng(seed) # one generator for every chunk (run_batch continues it rather than reseeding)
+        start_time = time.perf_counter()
+
+        # the chunks find the runout table in runout_cache if the expected rounds (worst case win rate 0.5) justify building it;
+        # under a time budget, no more evaluations than fit in the budget (building the table counts against it)
+        expected_rounds = max_rounds
+        if target_std_error is not None:
+            expected_rounds = min(max_rounds, max(MIN_ADAPTIVE_ROUNDS, int(0.25 / target_std_error ** 2)))
+        expected_evaluations = expected_rounds * (1 + len(self.scenario.opponents))
+        if time_budget is not None:
+            expected_evaluations = min(expected_evaluations, int(time_budget * EVALUATION_RATE))
+        self.get_runout_table(expected_evaluations)
+
+        while totals[0, 0] < max_rounds:
+            totals += self.run_batch(min(chunk_size, max_rounds - int(totals[0, 0])), rng, num_seats=num_seats, sampling=sampling)
+            count, total_wins = int(totals[0, 0]), int(totals[0, 1])
+
+            if progress is not None:
+                progress(count, total_wins, int(totals[0, 2]))
+            if self.stop_event.is_set():
+                break
+            if target_std_error is not None and count >= MIN_ADAPTIVE_ROUNDS and get_std_errors(totals[0])[0] <= target_std_error:
+                break
+            if time_budget is not None and time.perf_counter() - start_time >= time_budget:
+                break
+
+        return totals
+
+    def run_parallel(self, num_rounds, seed=None, executor=None, num_seats=1, sampling='random'):
+        """Method that splits num_rounds into seeded chunks, runs them with run_batch on a process pool and returns the merged
+            totals arrays of the first num_seats seats.  The result is deterministic for a given seed, whatever the number of workers."""
+        chunks = [PARALLEL_CHUNK_ROUNDS] * (num_rounds // PARALLEL_CHUNK_ROUNDS)
+        if num_rounds % PARALLEL_CHUNK_ROUNDS:
+            chunks.append(num_rounds % PARALLEL_CHUNK_ROUNDS)
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
 
-            if num_beaten == num_opponents:
-                total_wins += 1
-            elif num_tied == num_opponents:
-                total_ties += 1
+        start_time = time.perf_counter()
+        pool = executor
+        if pool is None:
+            pool = create_pool()
+        try:
+            totals = np.zeros((num_seats, TOTALS_SIZE), dtype=np.int64)
+            for chunk_totals in pool.map(run_chunk, [self.scenario] * len(chunks), chunks, seeds, [num_seats] * len(chunks), [sampling] * len(chunks)):
+                totals += chunk_totals
+        finally:
+            if executor is None:
+                pool.shutdown()
 
-        self.result = str(round(total_wins / count * 100)) + '%'
+        if self.metrics is not None: # (the workers' phases aren't visible from here)
+            self.metrics.add_time('parallel', time.perf_counter() - start_time)
+            self.metrics.count('batches', len(chunks))
+        return totals
 
-    def get_score(self, board_primes, hole_primes):
+    def get_runout_table(self, num_evaluations):
+        """Method that returns the runout table of the known board (see build_runout_table) from runout_cache, building it if
+            scoring num_evaluations hands would cost more, or None (fewer than 3 known board cards, or not worth building)"""
+        board_ids = sorted(card.id for card in self.scenario.board_cards)
+        if len(board_ids) < 3:
+            return None
+
+        cache_key = (self.evaluator, tuple(board_ids))
+        runout = runout_cache.get(cache_key)
+        if self.metrics is not None:
+            self.metrics.count('runout_cache_hits' if runout is not None else 'runout_cache_misses')
+        if runout is None:
+            # one evaluation per (board completion, holding) pair that doesn't share a card
+            num_missing_board = 5 - len(board_ids)
+            num_cells = math.comb(52 - len(board_ids), num_missing_board) * math.comb(47, 2)
+            if num_evaluations < num_cells:
+                return None
+            start_time = time.perf_counter()
+            runout = build_runout_table(self.evaluator, board_ids)
+            runout_cache.put(cache_key, runout)
+            if self.metrics is not None:
+                self.metrics.add_time('runout table', time.perf_counter() - start_time)
+                self.metrics.count('evaluations', num_cells)
+        return runout
+
+    def get_score(self, board_ids, hole_ids):
         """ Method that takes in Board Card IDs (list) and Hole Card IDs (list) and returns a hand score (int)"""
 
-        #list of the 7 cards that are available to the player (board cards + hole cards)
-        avbl_ids = board_primes + hole_primes
+        # score the 7 cards available to the player (board cards + hole cards) with the direct evaluator (from hash_tools.py)
+        return self.evaluator.evaluate(board_ids + hole_ids)
+
+
+class ResultCache:
+    """Class that holds simulation results in a size bounded LRU cache (thread safe) and counts hits and misses"""
+
+    def __init__(self, max_size=10*1000):
+        self.max_size = max_size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Method that returns the cached result for key (marking it as most recently used), or None"""
+        with self.lock:
+            result = self.results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        """Method that caches result for key, evicting the least recently used results beyond max_size"""
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def get_hit_rate(self):
+        """Method that returns the fraction of lookups that were hits (0 before any lookup)"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        """Method that empties the cache and resets the hit/miss counters"""
+        with self.lock:
+            self.results.clear()
+            self.hits = self.misses = 0
+
+def get_canonical_scenario(scenario):
+    """Function that returns a hashable canonical form of a Scenario: (hole Card ids, board Card ids, each opponent's known hole
+        Card ids, number of opponents, Range keys).
+        Suits are relabelled to give the smallest form over all 24 suit permutations, so suit isomorphic scenarios
+        (e.g. AsKs on 2h7h9d and AhKh on 2s7s9d) share one canonical form.  Card order within the hole and board cards doesn't matter.
+        Ranges that name specific suits (e.g. 'AhKh') aren't suit symmetric, so scenarios using one keep their own suits."""
+    hole_ids = [card.id - 1 for card in scenario.user.hole_cards]
+    board_ids = [card.id - 1 for card in scenario.board_cards]
+    opp_ids = [[card.id - 1 for card in opponent.hole_cards] for opponent in scenario.opponents]
+    ranges = [get_dealt_range(player) for player in [scenario.user] + scenario.opponents]
+
+    suit_permutations = SUIT_PERMUTATIONS
+    if not all(player_range is None or player_range.suit_symmetric for player_range in ranges):
+        suit_permutations = SUIT_PERMUTATIONS[:1] # identity only
+
+    canonical = None
+    for suits in suit_permutations:
+        form = (tuple(sorted(card_id - card_id % 4 + suits[card_id % 4] + 1 for card_id in hole_ids)),
+                tuple(sorted(card_id - card_id % 4 + suits[card_id % 4] + 1 for card_id in board_ids)),
+                tuple(tuple(sorted(card_id - card_id % 4 + suits[card_id % 4] + 1 for card_id in ids)) for ids in opp_ids))
+        if canonical is None or form < canonical:
+            canonical = form
+
+    range_keys = tuple(None if player_range is None else player_range.key for player_range in ranges)
+    return canonical + (len(scenario.opponents), range_keys)
+
+def build_runout_table(evaluator, board_ids, chunk_size=64):
+    """Function that scores every 2 card holding on every completion of a 3 to 5 card board and returns them as a
+        (completions, 1326) array indexed by [completion, HOLDING_INDEX[card_id_1, card_id_2]].  A turn's completions are
+        indexed by the river Card id, a flop's by the HOLDING_INDEX of its turn and river cards and a full board has one row.
+        Holdings sharing a card with the board are left at 0 (no deal can reach them), so one table serves any dead cards."""
+    num_missing_board = 5 - len(board_ids)
+    num_rows = [1, 53, len(HOLDING_IDS)][num_missing_board]
+    board_mask = sum(1 << card_id for card_id in board_ids)
+    holding_masks = (1 << HOLDING_IDS).sum(axis=1)
+
+    avbl_ids = [card_id for card_id in range(1, 53) if card_id not in board_ids]
+    completions = np.array(list(itertools.combinations(avbl_ids, num_missing_board)), dtype=np.int64)
+    completions = completions.reshape(math.comb(len(avbl_ids), num_missing_board), num_missing_board)
+    table = np.zeros((num_rows, len(HOLDING_IDS)), dtype=evaluator.rank_table_array.dtype)
+    for start in range(0, len(completions), chunk_size):
+        chunk = completions[start:start + chunk_size]
+        cards = np.empty((len(chunk), len(HOLDING_IDS), 7), dtype=np.int64)
+        cards[:, :, :len(board_ids)] = board_ids
+        cards[:, :, len(board_ids):5] = chunk[:, np.newaxis, :]
+        cards[:, :, 5:] = HOLDING_IDS
+
+        completion_masks = board_mask | (1 << chunk).sum(axis=1)
+        valid = (holding_masks & completion_masks[:, np.newaxis]) == 0
+        scores = np.zeros(valid.shape, dtype=table.dtype)
+        scores[valid] = evaluator.evaluate_batch(cards[valid])
+
+        if num_missing_board == 2:
+            table[HOLDING_INDEX[chunk[:, 0], chunk[:, 1]]] = scores
+        elif num_missing_board == 1:
+            table[chunk[:, 0]] = scores
+        else:
+            table[0] = scores[0]
+    return table
+
+def get_std_error(num_wins, num_rounds):
+    """Function that returns the standard error of a win probability estimated from num_wins out of num_rounds"""
+    win_rate = num_wins / num_rounds
+    return math.sqrt(win_rate * (1 - win_rate) / num_rounds)
+
+def get_std_errors(totals):
+    """Function that returns the standard errors of the win probability and the pot share equity estimated from a totals array.
+        Independently sampled rounds use the binomial and sample variances.  Variance reduced sampling (see Simulation.run) deals
+        replicates that are independent of each other but not within, so the errors come from the spread of the replicate means."""
+    count, wins, ties, shares, squared_shares = (int(total) for total in totals[:5])
+    num_replicates, squared_wins, squared_replicate_shares = (int(total) for total in totals[REPLICATE_TOTALS:REPLICATE_TOTALS + 3])
+    equity = shares / (POT_SHARE_UNITS * count)
+    if num_replicates < 2:
+        return get_std_error(wins, count), math.sqrt(max(0.0, squared_shares / POT_SHARE_UNITS ** 2 / count - equity ** 2) / count)
+
+    replicate_size = count / num_replicates
+    std_errors = []
+    for mean, squared_sum, units in [(wins / count, squared_wins, 1), (equity, squared_replicate_shares, POT_SHARE_UNITS)]:
+        # sample variance of the replicate means, over the number of replicates
+        variance = (squared_sum / (replicate_size * units) ** 2 - num_replicates * mean ** 2) / (num_replicates - 1)
+        std_errors.append(math.sqrt(max(0.0, variance) / num_replicates))
+    return std_errors[0], std_errors[1]
+
+def get_required_std_error(mode, num_rounds, target_std_error=None, time_budget=None):
+    """Function that returns the largest win probability standard error that answers a Simulation.run request: its target,
+        0 for mode 'exact', any for a time budget alone, else that of num_rounds independent deals at worst (a 50% win rate)"""
+    if target_std_error is not None:
+        return target_std_error
+    if mode == 'exact':
+        return 0.0
+    if time_budget is not None:
+        return math.inf
+    return math.sqrt(0.25 / num_rounds)
+
+def get_confidence_interval(win_rate, std_error):
+    """Function that returns the 95% confidence interval (low, high) of a win probability estimate, clipped to [0, 1]"""
+    return max(0.0, win_rate - CONFIDENCE_Z * std_error), min(1.0, win_rate + CONFIDENCE_Z * std_error)
+
+def get_evaluator():
+    """Function that returns the process wide Evaluator, loading the eval tables on first use (thread safe)"""
+    global _evaluator
+    evaluator = _evaluator
+    if evaluator is None:
+        with _evaluator_lock:
+            if _evaluator is None:
+                _evaluator = hash_tools.Evaluator()
+            evaluator = _evaluator
+    return evaluator
+
+def set_evaluator(evaluator):
+    """Function that swaps in a different Evaluator for every new Simulation (e.g. test tables) and returns the previous one.
+        Passing None resets the provider so the default tables are loaded again on next use."""
+    global _evaluator
+    with _evaluator_lock:
+        previous = _evaluator
+        _evaluator = evaluator
+    return previous
+
+def add_metrics_callback(callback):
+    """Function that registers callback(metrics) to be called with the Metrics of every Simulation run in this process
+        (e.g. to export them to a monitoring system).  Runs are instrumented while any callback is registered."""
+    _metrics_callbacks.append(callback)
+
+def remove_metrics_callback(callback):
+    """Function that unregisters a callback added with add_metrics_callback"""
+    _metrics_callbacks.remove(callback)
+
+def warm_up():
+    """Function that loads the shared eval tables ahead of the first Simulation and reads them once so their pages are resident"""
+    evaluator = get_evaluator()
+    evaluator.rank_table_array.max()
+    evaluator.flush_table_array.max()
+    return evaluator
+
+def create_pool(workers=None):
+    """Function that creates a process pool for parallel simulations (one worker per core by default).
+        The shared eval tables are loaded before the workers start, so forked workers inherit them instead of receiving a pickled copy."""
+    warm_up()
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=get_evaluator)
+
+def run_chunk(scenario, num_rounds, seed, num_seats=1, sampling='random'):
+    """Function that runs one chunk of a parallel simulation in a pool worker and returns its totals arrays"""
+    return Simulation(scenario).run_batch(num_rounds, seed, num_seats=num_seats, sampling=sampling)
+
+
+result_cache = ResultCache() # results shared by every Simulation.run (see use_cache)
+runout_cache = ResultCache(RUNOUT_CACHE_SIZE) # board runout tables shared by every Simulation (see get_runout_table)
 
-        #generate all possible 5 card combinations from avbl_ids
-        combos = itertools.combinations(avbl_ids, 5)
 
-        # lookup all card combos in the hand score hash table (from hash_tools.py) and return the best score (lowest)
-        score = min([self.lookup_score[reduce(lambda x, y: x * y, id_list)] for id_list in combos])
+class Metrics:
+    """Class that holds the instrumentation of one Simulation run (see Simulation.run's instrument): wall time per phase (seconds;
+        'load', 'cache', 'setup', 'enumeration', 'runout table', 'sampling', 'scoring', 'totals', 'scalar loop', 'parallel'),
+        counters ('evaluations' by the evaluator, 'runout_lookups', 'table_lookups', 'batches' and cache hits/misses),
+        trials per second and the process wide hit rates of result_cache and runout_cache"""
 
-        return score
+    def __init__(self):
+        self.mode = None
+        self.num_trials = 0
+        self.elapsed = 0.0
+        self.trials_per_second = 0.0
+        self.phase_times = {}
+        self.counters = {}
+        self.cache_hit_rates = {}
+
+    def add_time(self, phase, seconds):
+        """Method that adds seconds of wall time to a phase"""
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        """Method that adds amount to a counter"""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def finish(self, mode, num_trials, elapsed):
+        """Method that records the run's totals once it has finished"""
+        self.mode = mode
+        self.num_trials = num_trials
+        self.elapsed = elapsed
+        self.trials_per_second = num_trials / elapsed if elapsed > 0 else 0.0
+        self.cache_hit_rates = {'result_cache': result_cache.get_hit_rate(), 'runout_cache': runout_cache.get_hit_rate()}
+
+    def to_dict(self):
+        """Method that returns the metrics as a JSON serialisable dict"""
+        return {'mode': self.mode, 'num_trials': self.num_trials, 'elapsed': self.elapsed, 'trials_per_second': self.trials_per_second,
+                'phase_times': dict(self.phase_times), 'counters': dict(self.counters), 'cache_hit_rates': dict(self.cache_hit_rates)}
+
+
+class Results:
+    """Class that holds the outcome of a Simulation run: win, tie (split pot) and loss rates, pot share equity (split pots credited
+        as a fraction of the pot), standard errors, the number of trials, the elapsed time (seconds) and the distribution of the user's
+        final hand type.  str() gives the rounded win probability (e.g. '43%').  metrics holds the run's Metrics if it was instrumented."""
+
+    def __init__(self, totals, mode, elapsed=0.0, cancelled=False, metrics=None):
+        count, wins, ties, shares = (int(total) for total in totals[:4])
+        self.mode = mode # mode actually used (resolved from 'auto')
+        self.num_trials = count
+        self.wins = wins
+        self.ties = ties
+        self.losses = count - wins - ties
+        self.win_rate = wins / count
+        self.tie_rate = ties / count
+        self.loss_rate = self.losses / count
+        self.equity = shares / (POT_SHARE_UNITS * count)
+
+        # standard errors and the win probability's 95% confidence interval (exact results have no sampling error)
+        self.std_error = 0.0
+        self.equity_std_error = 0.0
+        if mode != 'exact':
+            self.std_error, self.equity_std_error = get_std_errors(totals)
+        self.confidence_interval = get_confidence_interval(self.win_rate, self.std_error)
+
+        self.hand_types = {hand_type: int(total) / count for hand_type, total in zip(hash_tools.HAND_TYPES, totals[5:REPLICATE_TOTALS])}
+        self.elapsed = elapsed
+        self.cancelled = cancelled # stopped early by Simulation.cancel (partial result)
+        self.metrics = metrics
+
+    def __str__(self):
+        return str(round(self.win_rate * 100)) + '%'
 
 
 class Scenario:
@@ -94,3 +915,177 @@ class Scenario:
         self.opponents = opponents # list of Player objects (Player objects defined in holdem_engine.py)
         self.board_cards = board_cards # list of cards on board (Card objects defined in holdem_engine.py)
 
+
+class Range:
+    """Class that represents a hand range: weighted 2 card combos parsed from standard notation, e.g. "QQ+, AKs, 76s-54s, ATo+:0.5, AhKh".
+        Tokens are comma separated and can end in ':weight' (default 1, 0 removes combos).  Combos are (high, low) pairs of Card ids."""
+
+    def __init__(self, notation=''):
+        self.notation = notation
+        self.weights = {} # combo -> weight
+        self.samplers = {} # frozenset of dead Card ids -> (combo array, AliasTable), see get_sampler
+        self.key = ()
+        self.suit_symmetric = True
+        if notation:
+            self.add(notation)
+
+    def __repr__(self):
+        return 'Range(' + repr(self.notation) + ')'
+
+    def add(self, notation, weight=1.0):
+        """Method that parses range notation and adds (or reweights) its combos"""
+        for token in notation.split(','):
+            token = token.strip()
+            if not token:
+                continue
+            token_weight = weight
+            if ':' in token:
+                token, token_weight = token.split(':', 1)
+                try:
+                    token_weight = float(token_weight)
+                except ValueError:
+                    raise ValueError("Invalid range weight: " + repr(token_weight))
+            if token_weight < 0:
+                raise ValueError("Range weights can't be negative: " + repr(token))
+            for combo in self.parse_token(token.strip()):
+                if token_weight > 0:
+                    self.weights[combo] = token_weight
+                else:
+                    self.weights.pop(combo, None)
+
+        # cached samplers, the cache key and suit symmetry all depend on the combos
+        self.samplers = {}
+        self.key = tuple(sorted(self.weights.items()))
+        class_weights = {}
+        for combo, combo_weight in self.weights.items():
+            class_weights.setdefault(hldm.get_hand_class(combo), []).append(combo_weight)
+        self.suit_symmetric = all(len(set(combo_weights)) == 1 and len(combo_weights) == get_class_size(hand_class)
+                                  for hand_class, combo_weights in class_weights.items())
+
+    def parse_token(self, token):
+        """Method that returns the combos of one range token: a hand class ('AKs', 'AKo', 'AK', 'QQ'), a class and better ('QQ+', 'ATs+'),
+            a span of classes ('QQ-99', 'KTs-K7s', '76s-54s') or a specific combo ('AhKh')"""
+        if len(token) == 4 and token[1].upper() in hldm.SUIT_CHARS and token[3].upper() in hldm.SUIT_CHARS:
+            first, second = hldm.str_to_card(token[:2]).id, hldm.str_to_card(token[2:]).id
+            if first == second:
+                raise ValueError("Invalid range combo: " + repr(token))
+            return [(max(first, second), min(first, second))]
+
+        if token.endswith('+'):
+            high, low, kind = parse_hand_class(token[:-1])
+            if high == low: # pairs up to Aces
+                classes = [(value, value) for value in range(low, 13)]
+            else: # kicker up to one below the high card
+                classes = [(high, value) for value in range(low, high)]
+        elif '-' in token:
+            start, end = token.split('-', 1)
+            start_high, start_low, kind = parse_hand_class(start)
+            end_high, end_low, end_kind = parse_hand_class(end)
+            if kind != end_kind:
+                raise ValueError("Invalid range span: " + repr(token))
+            if start_high == start_low and end_high == end_low: # pairs
+                classes = [(value, value) for value in range(min(start_high, end_high), max(start_high, end_high) + 1)]
+            elif start_high == end_high: # same high card, span of kickers
+                classes = [(start_high, value) for value in range(min(start_low, end_low), max(start_low, end_low) + 1)]
+            elif start_high - start_low == end_high - end_low: # same gap (connectors)
+                classes = [(value, value - start_high + start_low) for value in range(min(start_high, end_high), max(start_high, end_high) + 1)]
+            else:
+                raise ValueError("Invalid range span: " + repr(token))
+        else:
+            high, low, kind = parse_hand_class(token)
+            classes = [(high, low)]
+
+        combos = []
+        for high, low in classes:
+            for high_suit, low_suit in itertools.product(range(4), range(4)):
+                if high == low and high_suit <= low_suit:
+                    continue
+                if (kind == 's' and high_suit != low_suit) or (kind == 'o' and high_suit == low_suit):
+                    continue
+                combos.append((4 * high + high_suit + 1, 4 * low + low_suit + 1))
+        return combos
+
+    def get_sampler(self, dead_ids):
+        """Method that returns the range's combos that don't use any dead Card id, as an (n, 2) array, with an AliasTable over their weights.
+            Both are cached per set of dead cards."""
+        dead_ids = frozenset(dead_ids)
+        sampler = self.samplers.get(dead_ids)
+        if sampler is None:
+            combos = [combo for combo in self.weights if combo[0] not in dead_ids and combo[1] not in dead_ids]
+            if not combos:
+                raise ValueError("Every combo of " + repr(self) + " is blocked by the known cards")
+            sampler = (np.array(combos, dtype=np.int64), AliasTable([self.weights[combo] for combo in combos]))
+            self.samplers[dead_ids] = sampler
+        return sampler
+
+    def sample(self, rng, size, dead_ids):
+        """Method that draws size combos (weighted, none using a dead Card id) with a NumPy Generator and returns them as a (size, 2) array of Card ids"""
+        combos, alias_table = self.get_sampler(dead_ids)
+        return combos[alias_table.sample(rng, size)]
+
+    def sample_one(self, rndm, dead_ids):
+        """Method that draws one combo (weighted, not using a dead Card id) with a random.Random and returns it as a list of 2 Card ids"""
+        combos, alias_table = self.get_sampler(dead_ids)
+        return [int(card_id) for card_id in combos[alias_table.sample_one(rndm)]]
+
+class AliasTable:
+    """Class that samples indices in proportion to a list of weights in O(1) per draw (Vose's alias method)"""
+
+    def __init__(self, weights):
+        num_items = len(weights)
+        total = float(sum(weights))
+        probs = [weight * num_items / total for weight in weights]
+        aliases = list(range(num_items))
+        small = [i for i, prob in enumerate(probs) if prob < 1]
+        large = [i for i, prob in enumerate(probs) if prob >= 1]
+        while small and large:
+            i, j = small.pop(), large.pop()
+            aliases[i] = j
+            probs[j] -= 1 - probs[i]
+            if probs[j] < 1:
+                small.append(j)
+            else:
+                large.append(j)
+        for i in small + large: # left over from rounding
+            probs[i] = 1.0
+
+        self.probs = probs
+        self.aliases = aliases
+        self.probs_array = np.array(probs)
+        self.aliases_array = np.array(aliases, dtype=np.int64)
+
+    def sample(self, rng, size):
+        """Method that returns an array of size indices drawn with a NumPy Generator"""
+        indices = rng.integers(0, len(self.probs), size)
+        return np.where(rng.random(size) < self.probs_array[indices], indices, self.aliases_array[indices])
+
+    def sample_one(self, rndm):
+        """Method that returns one index drawn with a random.Random"""
+        i = rndm.randrange(len(self.probs))
+        return i if rndm.random() < self.probs[i] else self.aliases[i]
+
+def parse_hand_class(text):
+    """Function that parses a hand class such as 'AKs', 'T9o', 'AK' or 'QQ' and returns (high value, low value, kind), values being
+        0 (Two) to 12 (Ace) and kind 's', 'o' or '' (both)"""
+    name = text.strip()
+    kind = name[2:].lower()
+    if len(name) not in (2, 3) or kind not in ('', 's', 'o') or name[0].upper() not in hldm.VALUE_CHARS \
+            or name[1].upper() not in hldm.VALUE_CHARS:
+        raise ValueError("Invalid hand class: " + repr(text))
+    first, second = hldm.VALUE_CHARS.index(name[0].upper()), hldm.VALUE_CHARS.index(name[1].upper())
+    if first == second and kind:
+        raise ValueError("Pairs can't be suited or offsuit: " + repr(text))
+    return max(first, second), min(first, second), kind
+
+def get_class_size(hand_class):
+    """Function that returns the number of combos in a starting hand class (see holdem_engine.get_hand_class): 6, 4 or 12"""
+    row, column = divmod(hand_class, 13)
+    if row == column:
+        return 6
+    return 4 if row > column else 12
+
+def get_dealt_range(player):
+    """Function that returns the Range a Player's hole cards are dealt from (a range is used when the player has no known hole cards), or None"""
+    if player.range is not None and not player.hole_cards:
+        return player.range
+    return None
@@ -1,4 +1,5 @@
 import holdem_engine as hldm
+import random
 
 #TESTING HOLDEM_ENGINE HAND EVALUATION
 
@@ -31,3 +32,76 @@ while desired is False:
         print("Hand type, '" + hand.type + "', occurred after " + str(count) + " hands.")
 
 
+
+#TESTING SINGLE PASS EVALUATION AGAINST THE SEQUENTIAL CHECKS
+
+num_hands = 200000
+mismatches = 0
+for count in range(num_hands):
+    deck = hldm.Deck()
+    deck.shuffle()
+
+    set_of_cards = deck.cards[:random.choice([5, 6, 7, 8, 9])] # 8+ cards (e.g. trips, two pairs and kickers) too
+    hand = hldm.Hand()
+    hand.evaluate(set_of_cards)
+    reference = hldm.Hand()
+    reference.evaluate_sequential(set_of_cards)
+
+    if [hand.type, hand.name, hand.rank, hand.subranks, hand.cards, hand.kickers, hand.kickers_ordinals] != \
+            [reference.type, reference.name, reference.rank, reference.subranks, reference.cards, reference.kickers, reference.kickers_ordinals]:
+        mismatches += 1
+        print("Mismatch:", [card.name for card in set_of_cards], hand.name, "vs", reference.name)
+
+print(str(mismatches) + " mismatches in " + str(num_hands) + " random hands.")
+
+
+
+#TESTING THE DIRECT 7 CARD EVALUATOR AGAINST THE 21 COMBINATION HASH LOOKUP
+
+import hash_tools
+import itertools
+import numpy as np
+
+evaluator = hash_tools.Evaluator()
+hash_table = hash_tools.HashTable()
+primes = np.array([0] + hash_tools.get_primes(), dtype=np.uint64) # indexed by Card id
+combos = np.array(list(itertools.combinations(range(7), 5)))
+
+def get_reference_scores(hands):
+    """Function that scores (n, 7) Card ids the original way: the best hash lookup of the 21 five card combos"""
+    hash_ids = primes[hands[:, combos]].prod(axis=2)
+    return hash_table.lookup(hash_ids).min(axis=1)
+
+num_hands = 200000
+hands = np.array([random.sample(range(1, 53), 7) for _ in range(num_hands)])
+mismatches = np.count_nonzero(evaluator.evaluate_batch(hands) != get_reference_scores(hands))
+mismatches += sum(evaluator.evaluate(hand) != score for hand, score in zip(hands[:10000].tolist(), evaluator.evaluate_batch(hands[:10000])))
+print(str(mismatches) + " evaluator mismatches in " + str(num_hands) + " random hands.")
+
+# every flush rank pattern (5 to 7 ranks of one suit), padded with off suit cards of other ranks
+flush_hands = []
+for mask in range(8192):
+    ranks = [rank for rank in range(13) if mask >> rank & 1]
+    if 5 <= len(ranks) <= 7:
+        others = [rank for rank in range(13) if rank not in ranks][:7 - len(ranks)]
+        flush_hands.append([4 * rank + 1 for rank in ranks] + [4 * rank + 2 + index % 3 for index, rank in enumerate(others)])
+flush_hands = np.array(flush_hands)
+mismatches = np.count_nonzero(evaluator.evaluate_batch(flush_hands) != get_reference_scores(flush_hands))
+print(str(mismatches) + " evaluator mismatches in " + str(len(flush_hands)) + " flush patterns.")
+
+
+
+#TESTING THE SCALAR, BATCH AND EXACT SIMULATION MODES AGAINST EACH OTHER
+
+import simulation_engine as sim_engine
+
+for hole_cards, board, num_opponents in [('AsKs', 'Qs 7h 2c 9d', 1), ('7c7d', 'Ah Kd 2s 3c', 1), ('QhJh', 'Th 9c 2h 5s 5d', 2)]:
+    user = hldm.Player()
+    user.hole_cards = hldm.str_to_cards(hole_cards)
+    scenario = sim_engine.Scenario(user, [hldm.Player() for _ in range(num_opponents)], hldm.str_to_cards(board))
+    exact = sim_engine.Simulation(scenario).run(mode='exact', use_cache=False)
+    for mode in ['scalar', 'batch']:
+        result = sim_engine.Simulation(scenario).run(mode=mode, seed=0, num_rounds=20000, use_cache=False)
+        # the estimates should be within 4 standard errors of the exact win rate
+        status = "ok" if abs(result.win_rate - exact.win_rate) <= 4 * result.std_error else "MISMATCH"
+        print(hole_cards, board, mode, round(result.win_rate, 4), "vs exact", round(exact.win_rate, 4), status)